@@ -17,20 +17,21 @@
 # along with PatchCorral.  If not, see <http://www.gnu.org/licenses/>.
 ####################################################################################################
 
-from patchcorral.src.data.synthesizers.nordstage2 import mididevice as nordstage2
-from patchcorral.src.data.synthesizers.rolandfantomxr import mididevice as rolandfantomxr
-from patchcorral.src.data.synthesizers.generalmidi import mididevice as generalmidi
 from patchcorral.src.engine import mididevice
+import importlib
 import re
 
 
 
+## Synthesizer ID -> name of the module implementing its "MIDIInDevice" and "MIDIOutDevice"
+#  classes.  Names starting with "." are relative to this package.  The modules (and the banks
+#  they carry) are only imported once a matching device is used; see "getSynthesizer".
 SYNTHESIZERS = {
-  nordstage2.MIDIOutDevice.ID: nordstage2,
-  rolandfantomxr.MIDIOutDevice.ID: rolandfantomxr,
-  'Delta 1010LT MIDI': mididevice,
-  'Scarlett 18i20 USB': mididevice,
-  'default': generalmidi,
+  'Nord Stage 2 MIDI': '.nordstage2.mididevice',
+  'FANTOM-X': '.rolandfantomxr.mididevice',
+  'Delta 1010LT MIDI': 'patchcorral.src.engine.mididevice',
+  'Scarlett 18i20 USB': 'patchcorral.src.engine.mididevice',
+  'default': '.generalmidi.mididevice',
 }
 
 OPENINDEVICES = {}
@@ -68,10 +69,14 @@ def _getMIDIDevice(midiDevs, port=None, name=None):
     raise ValueError('Unable to parse synthesizer ID from name "{}".'.format(name))
   id = m.group(1)
   #Match the ID to a mididevice and return.
-  try:
-    return port, name, SYNTHESIZERS[id]
-  except KeyError:
-    return port, name, SYNTHESIZERS['default']
+  return port, name, getSynthesizer(id)
+
+##
+#  Returns the module implementing the given synthesizer, importing it if needed.
+#  @param id Synthesizer ID (see "SYNTHESIZERS").  Unknown IDs get the "default" module.
+#  @return src.data.synthesizers.*.mididevice module.
+def getSynthesizer(id):
+  return importlib.import_module(SYNTHESIZERS.get(id, SYNTHESIZERS['default']), __name__)
 
 ##
 #  Resolves a given port OR name to a MIDI Input device.
@@ -79,9 +79,6 @@ class MIDIOutDevice(mididevice.MIDIOutDevice):
   #  @param defaultChannel If given, will use this channel by default for all outgoing commands.
   def __init__(self, port, name, defaultChannel=None):
     patches = list(GM.PATCHES)
-    voices = []
-    for ch in range(1, 17):
-      for vname, msb, lsb, pc, group, vnn in patches:
-        voices.append(mididevice.MIDIVoice(vname, self, ch, msb, lsb, pc, group, vnn))
+    voices = mididevice.CATALOG.addVoices(self, patches, range(1, 17))
     super().__init__(port, name, voices, defaultChannel)
 
@@ -0,0 +1,53 @@
+####################################################################################################
+# Copyright 2013 John Crawford
+#
+# This file is part of PatchCorral.
+#
+# PatchCorral is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PatchCorral is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PatchCorral.  If not, see <http://www.gnu.org/licenses/>.
+####################################################################################################
+
+## @file
+#  The Roland Fantom-XR's bank modules and their compiled bank file (see engine.bankfile).
+#
+#  Build step: python -m patchcorral.src.data.synthesizers.rolandfantomxr.banks
+
+from patchcorral.src.engine import bankfile
+import os
+
+
+
+## Bank modules, in catalog order.
+MODULES = (
+  'UserVoices', 'PRA', 'PRB', 'PRC', 'PRD', 'PRE', 'PRF', 'PRG', 'PRH', 'GM',
+  'SRX04', 'SRX05', 'SRX06', 'SRX07', 'SRX09',
+)
+
+## Path of the compiled bank file.
+FILENAME = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'banks.cache')
+
+##
+#  Compiles the bank modules into "FILENAME".
+#  @return bankfile.File object.
+def build():
+  return bankfile.build(FILENAME, __package__, MODULES)
+
+##
+#  Loads the compiled banks, rebuilding "FILENAME" first if it is out of date with the modules.
+#  @return bankfile.File object.
+def load():
+  return bankfile.load(FILENAME, __package__, MODULES)
+
+if __name__ == '__main__':
+  bank = build()
+  print('{}: {} patches, {} strings'.format(FILENAME, len(bank), len(bank.strings) - 1))
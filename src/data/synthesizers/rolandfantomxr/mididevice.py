@@ -22,9 +22,8 @@
 #  @date 3/8/2013 Created file.  -jc
 #  @author John Crawford
 
-from . import UserVoices, PRA, PRB, PRC, PRD, PRE, PRF, PRG, PRH, GM, SRX04, SRX05, SRX06, SRX07, SRX09
+from . import banks
 from patchcorral.src.engine import mididevice
-import itertools
 
 
 
@@ -78,15 +77,10 @@ class MIDIOutDevice(mididevice.MIDIOutDevice):
   #  @param name String name of the MIDI device.  If "None", will use this class's ID string. 
   #  @param defaultChannel If given, will use this channel by default for all outgoing commands.
   def __init__(self, port, name, defaultChannel=None):
-    patches = list(itertools.chain(*map(
-      lambda x: x.PATCHES,
-      [
-        UserVoices, PRA, PRB, PRC, PRD, PRE, PRF, PRG, PRH, GM, SRX04, SRX05, SRX06, SRX07, SRX09,
-      ],
-    )))
-    voices = []
-    for ch in range(1, 17):
-      for vname, msb, lsb, pc, group, vnn in patches:
-        voices.append(mididevice.MIDIVoice(vname, self, ch, msb, lsb, pc, group, vnn))
+    bank = banks.load()
+    try:
+      voices = mididevice.CATALOG.addBank(self, bank, range(1, 17))
+    finally:
+      bank.close()
     super().__init__(port, name, voices, defaultChannel)
 
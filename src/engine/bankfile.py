@@ -0,0 +1,254 @@
+####################################################################################################
+# Copyright 2013 John Crawford
+#
+# This file is part of PatchCorral.
+#
+# PatchCorral is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PatchCorral is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PatchCorral.  If not, see <http://www.gnu.org/licenses/>.
+####################################################################################################
+
+## @file
+#  Compiled patch banks.  The bank modules of a synthesizer (Python modules holding a "PATCHES"
+#  list) are compiled into one binary file of fixed-width records plus a string table, stamped
+#  with a hash of the module sources.  The file is memory-mapped when loaded, so adding the banks
+#  to the catalog does not need to import, execute or build objects for the modules.
+#
+#  Usage: python -m patchcorral.src.engine.bankfile <cache file> <package> <module>...
+
+from . import file
+from array import array
+import hashlib
+import importlib
+import importlib.util
+import itertools
+import mmap
+import struct
+import sys
+
+
+
+## Identifies a compiled bank file.
+MAGIC = b'PCBANKS\0'
+
+## Incremented whenever the layout of the file changes.
+VERSION = 1
+
+## "(magic, version, source hash, number of records, size of the string table)", padded so the
+#  records are aligned.
+HEADER = struct.Struct('<8sI32sII12x')
+
+## "(name, category, voiceNum, msb, lsb, pc)".  Strings are stored as string table indexes.
+RECORD = struct.Struct('<IIIBBBx')
+
+## Offsets of the fields of a record, in units of the field's type (see "File.getColumn").
+FIELDS = {
+  'name': ('I', 0),
+  'category': ('I', 1),
+  'voiceNum': ('I', 2),
+  'msb': ('B', 12),
+  'lsb': ('B', 13),
+  'pc': ('B', 14),
+}
+
+##
+#  Raised when a compiled bank file is missing, damaged, or out of date with its sources.
+class StaleError(ValueError):
+  pass
+
+##
+#  Returns the hash identifying the current sources of the given bank modules.  The modules are
+#  read, not imported.
+#  @param package Name of the package holding the modules.
+#  @param modules Sequence of module names, relative to "package".
+#  @return 32-byte string.
+def getSourceHash(package, modules):
+  sourceHash = hashlib.sha256(struct.pack('<I', VERSION))
+  for module in modules:
+    sourceHash.update(module.encode('utf-8') + b'\0')
+    with open(importlib.util.find_spec('{}.{}'.format(package, module)).origin, 'rb') as fd:
+      sourceHash.update(fd.read())
+  return sourceHash.digest()
+
+##
+#  Imports the given bank modules and returns their patches.
+#  @param package Name of the package holding the modules.
+#  @param modules Sequence of module names, relative to "package".
+#  @return List of 6-tuples "(name, msb, lsb, pc, category, voiceNum)".
+def getPatches(package, modules):
+  return list(itertools.chain(*(
+    importlib.import_module('{}.{}'.format(package, module)).PATCHES for module in modules
+  )))
+
+##
+#  Compiles the given bank modules and saves the result.
+#  @param filename Path of the compiled bank file.
+#  @param package Name of the package holding the modules.
+#  @param modules Sequence of module names, relative to "package".
+#  @return File object.
+def build(filename, package, modules):
+  bank = File.fromPatches(getPatches(package, modules), getSourceHash(package, modules))
+  bank.save(filename)
+  return bank
+
+##
+#  Loads the compiled bank file for the given bank modules, rebuilding it first if it is missing
+#  or out of date.  If the rebuilt file cannot be saved, the compiled banks are used from memory.
+#  @param filename Path of the compiled bank file.
+#  @param package Name of the package holding the modules.
+#  @param modules Sequence of module names, relative to "package".
+#  @return File object.
+def load(filename, package, modules):
+  sourceHash = getSourceHash(package, modules)
+  try:
+    return File(filename, sourceHash)
+  except (OSError, StaleError):
+    pass
+  bank = File.fromPatches(getPatches(package, modules), sourceHash)
+  try:
+    bank.save(filename)
+  except OSError:
+    pass
+  return bank
+
+##
+#  Represents a compiled bank file: a header, "RECORD"-sized records, then the string table (the
+#  strings, UTF-8 encoded and separated by null characters).  String index 0 stands for "None";
+#  index "i" is the "i"th string of the table, counting from 1.
+class File(file.File):
+
+  ##
+  #  Class initializer.
+  #  @param filename Name of the file to load.  If "None", will not be associated with a file until
+  #    "load" or "save" is called.
+  #  @param sourceHash Hash the file must have been compiled from (see "getSourceHash").  If
+  #    "None", any hash is accepted.
+  #  @return "None".
+  def __init__(self, filename=None, sourceHash=None):
+    self.sourceHash = sourceHash
+    self.buffer = None
+    self.records = None
+    self.strings = [None]
+    self.map = None
+    self.filename = None
+    if filename is not None:
+      self.load(filename)
+
+  ##
+  #  Releases the memory map, if any.  The columns already returned are unaffected.
+  #  @return "None".
+  def close(self):
+    if self.records is not None:
+      self.records.release()
+      self.records = None
+    self.buffer = None
+    if self.map is not None:
+      self.map.close()
+      self.map = None
+
+  ##
+  #  Compiles the given patches.
+  #  @param patches Iterable of 6-tuples "(name, msb, lsb, pc, category, voiceNum)".
+  #  @param sourceHash Hash of the sources of the patches (see "getSourceHash").
+  #  @return File object, not yet associated with a file.
+  @classmethod
+  def fromPatches(cls, patches, sourceHash):
+    strings = {None: 0}
+    records = []
+    for name, msb, lsb, pc, category, voiceNum in patches:
+      indexes = []
+      for s in (name, category, voiceNum):
+        if s is not None and '\0' in s:
+          raise ValueError('Null character in bank string {!r}.'.format(s))
+        indexes.append(strings.setdefault(s, len(strings)))
+      records.append(RECORD.pack(*indexes, msb, lsb, pc))
+    table = '\0'.join(itertools.islice(strings, 1, None)).encode('utf-8')
+    bank = cls(sourceHash=sourceHash)
+    bank._parse(b''.join([
+      HEADER.pack(MAGIC, VERSION, sourceHash, len(records), len(table)),
+      b''.join(records),
+      table,
+    ]))
+    return bank
+
+  ##
+  #  Returns one field of every record.
+  #  @param field Field name (see "FIELDS").  String fields hold indexes into "self.strings".
+  #  @return Array of integers.
+  def getColumn(self, field):
+    typecode, offset = FIELDS[field]
+    step = RECORD.size // array(typecode).itemsize
+    column = array(typecode)
+    column.frombytes(self.records.cast(typecode)[offset::step].tobytes())
+    if sys.byteorder != 'little' and column.itemsize > 1:
+      column.byteswap()
+    return column
+
+  def __len__(self):
+    return len(self.records) // RECORD.size
+
+  def _load(self, filename):
+    self.close()
+    with open(filename, 'rb') as fd:
+      try:
+        self.map = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+      except ValueError:  #Empty file.
+        raise StaleError('Empty bank file "{}".'.format(filename))
+    try:
+      self._parse(self.map)
+    except:
+      self.close()
+      raise
+
+  ##
+  #  Validates the given contents of a compiled bank file and makes them this object's records
+  #  and strings.
+  #  @param buffer Bytes-like object.
+  #  @return "None".
+  def _parse(self, buffer):
+    if len(buffer) < HEADER.size:
+      raise StaleError('Truncated bank file.')
+    try:
+      magic, version, sourceHash, count, tableSize = HEADER.unpack_from(buffer)
+    except struct.error as e:
+      raise StaleError('Damaged header.') from e
+    if magic != MAGIC or version != VERSION:
+      raise StaleError('Not a bank file of version {}.'.format(VERSION))
+    if self.sourceHash is not None and sourceHash != self.sourceHash:
+      raise StaleError('Bank file is out of date with its sources.')
+    tableStart = HEADER.size + count * RECORD.size
+    if len(buffer) != tableStart + tableSize:
+      raise StaleError('Truncated bank file.')
+    strings = [None]
+    if tableSize:
+      try:
+        strings.extend(str(buffer[tableStart:], 'utf-8').split('\0'))
+      except UnicodeDecodeError as e:
+        raise StaleError('Damaged string table.') from e
+    self.buffer = buffer
+    self.sourceHash = sourceHash
+    self.records = memoryview(buffer)[HEADER.size:tableStart]
+    self.strings = strings
+    for field in ('name', 'category', 'voiceNum'):
+      if max(self.getColumn(field), default=0) >= len(strings):
+        self.close()
+        raise StaleError('Damaged record: string index out of range.')
+
+  def _save(self, filename):
+    with open(filename, 'wb') as fd:
+      fd.write(self.buffer)
+
+if __name__ == '__main__':
+  if len(sys.argv) < 4:
+    sys.exit('Usage: python -m patchcorral.src.engine.bankfile <cache file> <package> <module>...')
+  bank = build(sys.argv[1], sys.argv[2], sys.argv[3:])
+  print('{}: {} patches, {} strings'.format(sys.argv[1], len(bank), len(bank.strings) - 1))
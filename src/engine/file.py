@@ -22,9 +22,36 @@
 #  tracking modifications outside of the process.
 
 import os
+import shutil
+import tempfile
 
 
 
+##
+#  Returns the process's file mode creation mask.
+#  @return Integer mask.
+def getUmask():
+  umask = os.umask(0)
+  os.umask(umask)
+  return umask
+
+##
+#  Flushes the given directory's entries (e.g. a rename into it) to disk.  Does nothing where
+#  directories can't be opened (Windows).
+#  @param dirname Path of the directory.
+#  @return "None".
+def syncDir(dirname):
+  try:
+    fd = os.open(dirname, os.O_RDONLY)
+  except OSError:
+    return
+  try:
+    os.fsync(fd)
+  except OSError:
+    pass
+  finally:
+    os.close(fd)
+
 ##
 #  Represents a file in the file system.  Simplifies operations such as loading, saving, and
 #  tracking modifications outside of the process.
@@ -62,7 +89,9 @@ class File():
     pass
 
   ##
-  #  Saves the current contents to file.
+  #  Saves the current contents to file.  The contents are written to a temporary file next to
+  #  the destination, flushed to disk and then renamed over it, so the file is never left
+  #  partially written.  An existing file's permissions are kept.
   #  @param filename Path to save to.
   #  @return "None".
   def save(self, filename=None):
@@ -70,7 +99,25 @@ class File():
       if self.filename is None:
         raise ValueError('No associated filename.  One must be provided.')
       filename = self.filename
-    self._save(filename)
+    fd, tmpFilename = tempfile.mkstemp(
+      prefix='.{}.'.format(os.path.basename(filename)),
+      suffix='.tmp',
+      dir=os.path.dirname(os.path.abspath(filename)),
+    )
+    os.close(fd)
+    try:
+      self._save(tmpFilename)
+      with open(tmpFilename, 'rb+') as f:
+        os.fsync(f.fileno())
+      try:
+        shutil.copymode(filename, tmpFilename)
+      except FileNotFoundError:
+        os.chmod(tmpFilename, 0o666 & ~getUmask())
+      os.replace(tmpFilename, filename)
+    except:
+      os.remove(tmpFilename)
+      raise
+    syncDir(os.path.dirname(os.path.abspath(filename)))
     self.filename = filename
 
   ##
@@ -0,0 +1,128 @@
+####################################################################################################
+# Copyright 2013 John Crawford
+#
+# This file is part of PatchCorral.
+#
+# PatchCorral is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PatchCorral is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PatchCorral.  If not, see <http://www.gnu.org/licenses/>.
+####################################################################################################
+
+## @file
+#  Represents a YAML document saved as a snapshot plus an append-only journal of the edits made
+#  since.  Edits are appended as they happen, so their cost tracks the size of the edit rather
+#  than the document; saving writes a new snapshot and empties the journal ("compaction").
+
+from . import yamlfile
+import os
+import yaml
+
+
+
+##
+#  Represents a YAML snapshot (a dictionary) with a journal of edits kept next to it, in
+#  "<filename>.journal".  Each journal line is a YAML flow sequence "[seq, ...entry]", where "seq"
+#  numbers the entries.  The snapshot records the last entry it includes under the "journal" key,
+#  so entries written before a compaction was interrupted are never applied twice.
+class File(yamlfile.File):
+
+  ## Snapshot key holding the sequence number of the last journal entry included.
+  SEQ_KEY = 'journal'
+
+  ## Line width given to the dumper, so each entry stays on one line.
+  LINE_WIDTH = 1 << 30
+
+  ##
+  #  Class initializer.
+  #  @param filename Name of the snapshot file to load.  If "None", will not be associated with a
+  #    file until "load" or "save" is called.
+  #  @param root Dictionary.
+  #  @return "None".
+  def __init__(self, filename=None, root=None):
+    self.entries = []
+    self.seq = 0
+    super().__init__(filename, root)
+
+  ##
+  #  Appends the given entries to the journal and flushes them to disk.
+  #  @param entries List of entries.  Each is a list of plain YAML values.
+  #  @return "None".
+  def append(self, entries):
+    if self.filename is None:
+      raise ValueError('No associated filename.  Call "save" first.')
+    lines = []
+    for entry in entries:
+      self.seq += 1
+      lines.append(yaml.dump(
+        [self.seq] + list(entry),
+        Dumper=yamlfile.Dumper,
+        default_flow_style=True,
+        width=self.LINE_WIDTH,
+      ))
+    with open(self.getJournalFilename(), 'a') as fd:
+      fd.write(''.join(lines))
+      fd.flush()
+      os.fsync(fd.fileno())
+    self.entries.extend(entries)
+
+  ##
+  #  Returns the entries journaled since the snapshot was saved, oldest first.
+  #  @return List of entries.
+  def getEntries(self):
+    return self.entries
+
+  ##
+  #  Returns the path of the journal.
+  #  @param filename Snapshot path.  If "None", uses the associated file.
+  #  @return String.
+  def getJournalFilename(self, filename=None):
+    if filename is None:
+      filename = self.filename
+    return filename + '.journal'
+
+  def _load(self, filename):
+    super()._load(filename)
+    snapshotSeq = self.root.get(self.SEQ_KEY, 0) if isinstance(self.root, dict) else 0
+    self.seq = snapshotSeq
+    self.entries = []
+    try:
+      fd = open(self.getJournalFilename(filename), 'r+')
+    except FileNotFoundError:
+      return
+    with fd:
+      end = 0
+      for line in iter(fd.readline, ''):
+        try:
+          entry = yaml.load(line, Loader=yamlfile.Loader)
+        except yaml.YAMLError:
+          entry = None
+        if not line.endswith('\n') or not isinstance(entry, list) or len(entry) < 2:
+          #An append was interrupted.  Drop it so later appends start on a fresh line.
+          fd.truncate(end)
+          break
+        end = fd.tell()
+        if entry[0] > snapshotSeq:
+          self.entries.append(entry[1:])
+          self.seq = entry[0]
+
+  ##
+  #  Saves a snapshot of the current root, then empties the journal.
+  #  @param filename Path to save to.
+  #  @return "None".
+  def save(self, filename=None):
+    self.root[self.SEQ_KEY] = self.seq
+    super().save(filename)
+    try:
+      os.remove(self.getJournalFilename())
+    except FileNotFoundError:
+      pass
+    self.entries = []
@@ -20,9 +20,17 @@
 ## @file
 #  Defines a base class for MIDI devices.
 
+from . import voicecatalog
+from . import voicefilter
+from . import yamlfile
 # from patchcorral.src.data import synthesizers  #Imported below to dodge circular import errors.  Yes, I know this usually means I could have designed something better.
 from PySide import QtCore
-import re  #For user-defined iteration filters.
+import collections
+import contextlib
+import functools
+import json
+import operator
+import re
 import rtmidi
 import threading
 import time
@@ -31,6 +39,15 @@ import yaml
 
 
 
+##
+#  Returns a function that reads the given key from a voice, e.g. "device.portName" reads
+#  "voice.device.portName".  Compiled once per key, so the key isn't parsed on each read.
+#  @param key String of attribute names separated by ".".
+#  @return Function taking a MIDIVoice object.
+@functools.lru_cache(maxsize=None)
+def getAccessor(key):
+  return operator.attrgetter(key)
+
 ##
 #  Returns a list of the available MIDI Input Devices.
 #  @return List of tuples "(portNum, portName)".
@@ -50,9 +67,13 @@ def getMIDIOutDevices():
   return list((port, midi.get_port_name(port)) for port in range(midi.get_port_count()) if 'FANTOM-X' in midi.get_port_name(port))
 
 ##
-#  Class representing a specific MIDI voice.
+#  Class representing a specific MIDI voice.  Patches are stored as rows of a
+#  voicecatalog.VoiceCatalog; objects of this class are thin views pairing a row
+#  with a channel.
 class MIDIVoice():
 
+  __slots__ = ('catalog', 'row', 'channel')
+
   tags = [
     'name',
     'msb',
@@ -65,8 +86,22 @@ class MIDIVoice():
     'voiceNum',
   ]
 
+  ## Reads the values of all "tags" at once (see "MIDIVoice.getDisplayRow").
+  _getTagValues = operator.attrgetter(*tags)
+
+  ## Most display rows kept cached (see "MIDIVoice.getDisplayRow"); a few screens' worth.
+  DISPLAY_ROW_CACHE_SIZE = 1024
+
+  name = voicecatalog.columnProperty('name')
+  device = voicecatalog.columnProperty('device')
+  msb = voicecatalog.columnProperty('msb')
+  lsb = voicecatalog.columnProperty('lsb')
+  _pc = voicecatalog.columnProperty('pc')
+  category = voicecatalog.columnProperty('category')
+  voiceNum = voicecatalog.columnProperty('voiceNum')
+
   ##
-  #  Class constructor.
+  #  Class constructor.  Adds a new patch to the shared catalog "CATALOG".
   #  @param name String
   #  @param device MIDIOutDevice object
   #  @param channel MIDI Channcel (1-16)
@@ -76,24 +111,57 @@ class MIDIVoice():
   #  @param category Category of the voice
   #  @param voiceNum Number of the voice as displayed on the device
   def __init__(self, name, device, channel, msb, lsb, pc, category=None, voiceNum=None):
-    self.name = name
-    self.device = device
+    self.catalog = CATALOG
+    self.row = CATALOG.addPatch(name, device, msb, lsb, pc, category, voiceNum)
     self.channel = channel
-    self.msb = msb
-    self.lsb = lsb
-    self._pc = pc
-    self.category = category
-    self.voiceNum = voiceNum
+
+  ##
+  #  Voices are views, so two views of the same catalog row and channel are the same voice.
+  def __eq__(self, other):
+    if not isinstance(other, MIDIVoice):
+      return NotImplemented
+    return self.catalog is other.catalog and self.row == other.row and self.channel == other.channel
+
+  ##
+  #  Creates a view of an existing catalog row without adding a new one.
+  #  @param catalog voicecatalog.VoiceCatalog object.
+  #  @param row Integer row.
+  #  @param channel MIDI Channel (1-16)
+  #  @return MIDIVoice object.
+  @classmethod
+  def fromCatalog(cls, catalog, row, channel):
+    self = cls.__new__(cls)
+    self.catalog = catalog
+    self.row = row
+    self.channel = channel
+    return self
 
   def __getitem__(self, key):
-    keys = key.split('.')
-    v = self
-    for k in keys:
-      try:
-        v = getattr(v, k)
-      except AttributeError:
-        raise KeyError('Unable to find key {}.'.format(key))
-    return v
+    try:
+      return getAccessor(key)(self)
+    except AttributeError:
+      raise KeyError('Unable to find key {}.'.format(key))
+
+  ##
+  #  Returns the display strings of this voice's "tags", in order.  The most
+  #  recently used "DISPLAY_ROW_CACHE_SIZE" rows are cached until the catalog
+  #  changes.
+  #  @return Tuple of strings.
+  def getDisplayRow(self):
+    try:
+      rows = self.catalog.cache['displayRows']
+    except KeyError:
+      rows = self.catalog.cache['displayRows'] = collections.OrderedDict()
+    voiceId = (self.row << voicecatalog.CHANNEL_BITS) | self.channel
+    try:
+      ret = rows[voiceId]
+    except KeyError:
+      ret = rows[voiceId] = tuple(map(str, self._getTagValues(self)))
+      if len(rows) > self.DISPLAY_ROW_CACHE_SIZE:
+        rows.popitem(False)
+    else:
+      rows.move_to_end(voiceId)
+    return ret
 
   ##
   #  Generates a pickle-able state for this object.
@@ -110,6 +178,28 @@ class MIDIVoice():
       "voiceNum": self.voiceNum,
     }
 
+  def __hash__(self):
+    return hash((id(self.catalog), self.row, self.channel))
+
+  ##
+  #  Canonical identity of this voice: what the device needs to select it.
+  #  Voices with the same identity are the same sound, however they were created.
+  @property
+  def identity(self):
+    return (self.device.get_port_name(), self.msb, self.lsb, self._pc, self.channel)
+
+  ##
+  #  "identity" as a string, "<portName> <msb> <lsb> <pc> <channel>", as stored in the user data
+  #  (see "internIdentityKey").  A patch that none of the device's banks offer can't be looked up
+  #  again when loaded, so its key is followed by a tab and its name, category and voiceNum as a
+  #  JSON list.
+  @property
+  def identityKey(self):
+    key = '{} {} {} {} {}'.format(*self.identity)
+    if self.row in self.catalog.extraRows:
+      key += '\t' + json.dumps([self.name, self.category, self.voiceNum])
+    return key
+
   def __iter__(self):
     return (tag for tag in self.tags)
 
@@ -147,13 +237,19 @@ class MIDIVoice():
     setattr(v, keys[-1], val)
 
   ##
-  #  Receives a pickled state and attempts to reproduce the original object.
+  #  Receives a pickled state and attempts to reproduce the original object.  The
+  #  voice is looked up by its canonical identity, so voices loaded from file refer
+  #  to the catalog rows of the devices' own voices instead of adding copies.  The
+  #  device is resolved through the active "DeviceBinder" (see "bindDevices").
   #  @return "None".
   def __setstate__(self, state):
-    from patchcorral.src.data import synthesizers  #imported here to dodge circular import errors
-    state["device"] = synthesizers.getMIDIOutDevice(None, state["deviceName"])
+    binder = BINDER if BINDER is not None else DeviceBinder()
+    state["device"] = binder.getDevice(state["deviceName"])
     del state["deviceName"]
-    self.__init__(**state)
+    voice = internVoice(**state)
+    self.catalog = voice.catalog
+    self.row = voice.row
+    self.channel = voice.channel
 
   ##
   #  Method for converting this object to string.  Prints out essential information.
@@ -164,6 +260,125 @@ class MIDIVoice():
     for key in iter(self):
       yield self[key]
 
+  ##
+  #  Integer ID packing this voice's catalog row and channel (see voicecatalog.voiceId).
+  @property
+  def voiceId(self):
+    return voicecatalog.voiceId(self.row, self.channel)
+
+## Catalog shared by all voices of all devices.
+CATALOG = voicecatalog.VoiceCatalog(MIDIVoice)
+
+##
+#  Returns the voice with the given canonical identity (see "MIDIVoice.identity"),
+#  reusing the catalog row already holding the patch.  A row is only added if the
+#  device doesn't offer the patch.
+#  @param device MIDIOutDevice object
+#  @param channel MIDI Channel (1-16)
+#  @param msb Most Significant Bit
+#  @param lsb Least Significant Bit
+#  @param pc Program Change value
+#  @param name String.  Only used if a row has to be added.
+#  @param category Category of the voice.  Only used if a row has to be added.
+#  @param voiceNum Number of the voice as displayed on the device.  Only used if a row has to be
+#    added.
+#  @return MIDIVoice object.
+def internVoice(device, channel, msb, lsb, pc, name=None, category=None, voiceNum=None):
+  with CATALOG.lock:
+    row = CATALOG.findRow(device, msb, lsb, pc)
+    if row is None:
+      row = CATALOG.addPatch(name, device, msb, lsb, pc, category, voiceNum)
+  return MIDIVoice.fromCatalog(CATALOG, row, channel)
+
+##
+#  Returns the voice with the given identity key, as stored in the user data.
+#  @param key String returned by "MIDIVoice.identityKey".  The port name may contain spaces.
+#  @param binder DeviceBinder object resolving the port name.  If "None", uses the active one (see
+#    "bindDevices"), or a new one if none is active.
+#  @throws ValueError If the key is malformed.
+#  @return MIDIVoice object.
+def internIdentityKey(key, binder=None):
+  if binder is None:
+    binder = BINDER if BINDER is not None else DeviceBinder()
+  key, _, extra = key.partition('\t')
+  portName, msb, lsb, pc, channel = key.rsplit(' ', 4)
+  name, category, voiceNum = json.loads(extra) if extra else (None, None, None)
+  return internVoice(
+    binder.getDevice(portName), int(channel), int(msb), int(lsb), int(pc), name, category, voiceNum
+  )
+
+##
+#  Resolves MIDI output device names to devices for voices being loaded.  The ports are enumerated
+#  the first time a name is resolved, and each distinct name is only resolved once, so loading
+#  many voices doesn't query the MIDI ports for each of them.
+class DeviceBinder():
+
+  ##
+  #  Class initializer.
+  #  @return "None".
+  def __init__(self):
+    self.midiDevs = None  #Port list, enumerated on first use.
+    self.devices = {}  #Port name -> MIDIOutDevice object.
+
+  ##
+  #  Returns the output device with the given port name.
+  #  @param name Port name.
+  #  @throws ValueError If no port has the given name.
+  #  @return MIDIOutDevice object.
+  def getDevice(self, name):
+    try:
+      return self.devices[name]
+    except KeyError:
+      pass
+    from patchcorral.src.data import synthesizers  #imported here to dodge circular import errors
+    if self.midiDevs is None:
+      self.midiDevs = getMIDIOutDevices()
+    ret = self.devices[name] = synthesizers.getMIDIOutDevice(None, name, self.midiDevs)
+    return ret
+
+## DeviceBinder shared by the voices being loaded while "bindDevices" is active.
+BINDER = None
+
+##
+#  Context manager sharing one DeviceBinder between all voices loaded within it (such as those
+#  created by "MIDIVoice.__setstate__" while parsing a file).  Nested uses share the outermost
+#  binder.
+#  @return DeviceBinder object, as the context's value.
+@contextlib.contextmanager
+def bindDevices():
+  global BINDER
+  outer = BINDER
+  if outer is None:
+    BINDER = DeviceBinder()
+  try:
+    yield BINDER
+  finally:
+    BINDER = outer
+
+## YAML tag of a MIDIVoice, as written by the full (unsafe) PyYAML dumper in older user data files.
+VOICE_TAG = 'tag:yaml.org,2002:python/object:{}.{}'.format(MIDIVoice.__module__, MIDIVoice.__qualname__)
+
+##
+#  Constructs a MIDIVoice from a YAML mapping of its pickled state (see "MIDIVoice.__setstate__").
+#  @param loader yamlfile.Loader object.
+#  @param node YAML mapping node.
+#  @return MIDIVoice object.
+def _constructVoice(loader, node):
+  voice = MIDIVoice.__new__(MIDIVoice)
+  voice.__setstate__(loader.construct_mapping(node))
+  return voice
+
+##
+#  Represents a MIDIVoice as a YAML mapping of its pickled state (see "MIDIVoice.__getstate__").
+#  @param dumper yamlfile.Dumper object.
+#  @param voice MIDIVoice object.
+#  @return YAML mapping node.
+def _representVoice(dumper, voice):
+  return dumper.represent_mapping(VOICE_TAG, voice.__getstate__())
+
+yamlfile.Loader.add_constructor(VOICE_TAG, _constructVoice)
+yamlfile.Dumper.add_representer(MIDIVoice, _representVoice)
+
 ##
 #  Class representing a MIDI Device.  This is an abstract base class that
 #  doesn't do anything on its own.  Subclasses must populate "self.midi" with
@@ -290,13 +505,16 @@ class MIDIOutDevice(MIDIDevice):
   #  Class initializer.
   #  @param port Integer port number for the MIDI device.
   #  @param name String name of the MIDI device.  If "None", will use this class's ID string.
-  #  @param voices List of MIDIVoice objects available from this MIDI Device.
+  #  @param voices List of MIDIVoice objects (or a voicecatalog.VoiceSequence) available from this
+  #    MIDI Device.
   #  @param defaultChannel If given, will use this channel by default for all outgoing commands.
   def __init__(self, port, name=None, voices=None, defaultChannel=None):
     if name is None:
       name = MIDIOutDevice.ID
     if voices is None:
       voices = []
+    if not isinstance(voices, voicecatalog.VoiceSequence):
+      voices = CATALOG.voices(voice.voiceId for voice in voices)
     self.midi = rtmidi.MidiOut()
     super().__init__(port, name)
     self.voices = voices
@@ -316,17 +534,19 @@ class MIDIOutDevice(MIDIDevice):
 
   ##
   #  Returns the full list of voices available from this device.
+  #  @return voicecatalog.VoiceSequence object.
   def getVoiceList(self):
-    return list(self.voices)
+    return self.voices
 
   ##
   #  Returns an iterator that steps over the voices.  Supports filtering.
   #  @param filter Python statement that can be evaluated such that "v" stands for a MIDIVoice
-  #    object.
+  #    object.  See voicefilter.parseFilter for what the statement may contain.
   #  @return Iterator object that returns MIDIVoice objects.
   def iter(self, filter='True'):
+    f = voicefilter.compileFilter(filter)
     for v in self.voices:
-      if eval(filter):
+      if f(v):
         yield v
 
   ##
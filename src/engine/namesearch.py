@@ -0,0 +1,194 @@
+﻿####################################################################################################
+# Copyright 2013 John Crawford
+#
+# This file is part of PatchCorral.
+#
+# PatchCorral is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PatchCorral is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PatchCorral.  If not, see <http://www.gnu.org/licenses/>.
+####################################################################################################
+
+## @file
+#  Fuzzy search over voice names and voice numbers, backed by a trigram inverted index.  Text is
+#  compared case-insensitively with everything but letters and digits removed, so "sawbas" finds
+#  "Flat SawBass".
+
+from . import voicecatalog
+from . import voiceindex
+from array import array
+import collections
+import re
+
+
+
+##
+#  Normalizes the given text for matching.
+#  @param text String.
+#  @return Lowercase string of letters and digits.
+def normalize(text):
+  return re.sub(r'[^0-9a-z]', '', str(text).lower())
+
+##
+#  Returns the trigrams of the given normalized text.  Text shorter than three characters is its
+#  own only gram.
+#  @param text Normalized string.
+#  @return Set of strings.
+def trigrams(text):
+  if len(text) < 3:
+    return set((text,)) if text else set()
+  return set(text[i:i + 3] for i in range(len(text) - 2))
+
+##
+#  Returns the one- and two-character substrings of the given normalized text, used to answer
+#  queries too short to have trigrams.
+#  @param text Normalized string.
+#  @return Set of strings.
+def shortGrams(text):
+  return set(text[i:i + n] for n in (1, 2) for i in range(len(text) - n + 1))
+
+##
+#  Trigram index over the "name" and "voiceNum" columns of a voicecatalog.VoiceCatalog.  Each
+#  distinct string is indexed once; rows added to the catalog are indexed incrementally the next
+#  time the index is used.  Queries shorter than a trigram use a second index of each string's
+#  one- and two-character substrings.
+class TrigramIndex():
+
+  ## Indexed catalog columns.
+  COLUMNS = ('name', 'voiceNum')
+
+  ##
+  #  Class initializer.
+  #  @param catalog voicecatalog.VoiceCatalog object.
+  #  @return "None".
+  def __init__(self, catalog):
+    self.catalog = catalog
+    self.postings = None
+    self.shortPostings = None
+    self.strings = None
+    self.rows = None
+    self.numRows = None
+    self.revision = None
+    self.update()
+
+  ##
+  #  Returns the catalog rows whose name or voice number matches the given text, best matches
+  #  first.  A string matches if it shares at least half of the text's trigrams; matches are
+  #  ranked by the fraction shared, with a bonus for containing (or starting with) the text.
+  #  @param text String to search for.
+  #  @param limit Maximum number of rows to return.  If "None", returns all matches.
+  #  @return List of integer rows.
+  def search(self, text, limit=None):
+    self.update()
+    query = normalize(text)
+    if len(query) == 0:
+      return []
+    if len(query) < 3:
+      counts = dict((key, 1) for key in self.shortPostings.get(query, ()))
+      grams = (query,)
+    else:
+      grams = trigrams(query)
+      counts = collections.Counter()
+      for gram in grams:
+        counts.update(self.postings.get(gram, ()))
+    needed = max(1, (len(grams) + 1) // 2)
+    scores = {}
+    for key, count in counts.items():
+      if count < needed:
+        continue
+      string = self.strings[key]
+      score = count / len(grams)
+      if query in string:
+        score += 1.0 if string.startswith(query) else 0.5
+      rank = (-score, len(string))
+      for row in self.rows[key]:
+        if rank < scores.get(row, (0, 0)):
+          scores[row] = rank
+    ret = sorted(scores, key=lambda row: (scores[row], row))
+    if limit is not None:
+      ret = ret[:limit]
+    return ret
+
+  ##
+  #  Brings the index up to date with the catalog.  New rows are added incrementally; if existing
+  #  rows were modified, the index is rebuilt.  Holds the catalog's lock while changing the index.
+  #  @return "None".
+  def update(self):
+    if self.revision == self.catalog.revision and self.numRows == len(self.catalog):
+      return
+    with self.catalog.lock:
+      if self.revision != self.catalog.revision:
+        self.postings = {}
+        self.shortPostings = {}
+        self.strings = {}
+        self.rows = {}
+        self.numRows = 0
+        self.revision = self.catalog.revision
+      numRows = len(self.catalog)
+      if numRows == self.numRows:
+        return
+      for column in self.COLUMNS:
+        values = self.catalog.tables[column].values
+        for row, code in enumerate(self.catalog.columns[column][self.numRows:], self.numRows):
+          key = (column, code)
+          try:
+            self.rows[key].append(row)
+          except KeyError:
+            self.rows[key] = array('I', (row,))
+            string = self.strings[key] = normalize(values[code]) if values[code] is not None else ''
+            for gram in trigrams(string):
+              try:
+                self.postings[gram].add(key)
+              except KeyError:
+                self.postings[gram] = set((key,))
+            for gram in shortGrams(string):
+              try:
+                self.shortPostings[gram].add(key)
+              except KeyError:
+                self.shortPostings[gram] = set((key,))
+      self.numRows = numRows
+
+##
+#  Orders the given voices by the given ranking of catalog rows, dropping voices whose row isn't
+#  ranked.  Voices made of voicecatalog.ChannelProduct parts stay virtual (ranked rows on the
+#  first channel, then the second, and so on).  The rows of "voices" are cached on the sequence.
+#  @param voices voicecatalog.VoiceSequence object.
+#  @param rows List of integer rows, best first.
+#  @param limit Maximum number of rows to keep, counting only rows found in "voices".  If "None",
+#    keeps all of them.
+#  @return voicecatalog.VoiceSequence object.
+def rankVoices(voices, rows, limit=None):
+  catalog = voices.catalog
+  try:
+    products, members = voices.cache['rankMembers']
+  except KeyError:
+    products = voiceindex.getProducts(voices.voiceIds)
+    if products is None:
+      members = {}
+      for vid in voices.voiceIds:
+        members.setdefault(vid >> voicecatalog.CHANNEL_BITS, []).append(vid)
+    else:
+      products = [product for product in products if len(product.channels) > 0]
+      members = [
+        product.rows if isinstance(product.rows, range) else set(product.rows)
+        for product in products
+      ]
+    voices.cache['rankMembers'] = (products, members)
+  if products is None:
+    rows = [row for row in rows if row in members][:limit]
+    return catalog.voices(vid for row in rows for vid in members[row])
+  rows = [row for row in rows if any(row in m for m in members)][:limit]
+  parts = []
+  for product, m in zip(products, members):
+    ranked = array('I', (row for row in rows if row in m))
+    if len(ranked) > 0:
+      parts.append(voicecatalog.ChannelProduct(ranked, product.channels))
+  return catalog.voices(voicecatalog.IdChain(parts))
@@ -0,0 +1,389 @@
+####################################################################################################
+# Copyright 2013 John Crawford
+#
+# This file is part of PatchCorral.
+#
+# PatchCorral is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PatchCorral is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PatchCorral.  If not, see <http://www.gnu.org/licenses/>.
+####################################################################################################
+
+## @file
+#  Represents a SQLite database holding the user's voice lists and a copy of the voice catalog.
+#  It stands in for journalfile.File: list edits are applied as they're appended, each in its own
+#  transaction, and facet filters can be answered with indexed queries on the catalog copy.
+
+from . import file
+from . import vectorfilter
+from . import voicefilter
+from . import voiceindex
+import ast
+import sqlite3
+import threading
+
+
+
+##
+#  The stored identity keys of one voice list.  The keys are only read from the database when
+#  iterated.
+class StoredKeys():
+
+  ##
+  #  Class initializer.
+  #  @param file File object holding the list.
+  #  @param name Name of the voice list.
+  #  @param size Number of voices in the list.
+  #  @return "None".
+  def __init__(self, file, name, size):
+    self.file = file
+    self.name = name
+    self.size = size
+
+  def __iter__(self):
+    return iter(self.file.getVoiceKeys(self.name))
+
+  def __len__(self):
+    return self.size
+
+##
+#  Represents a SQLite database of voice lists (see "File.getRoot") and of the rows of a
+#  voicecatalog.VoiceCatalog.  The connection may be used from any thread.
+class File(file.File):
+
+  ## Statements creating the schema.  "listVoices" stores one row per voice of each list, with the
+  #  voice's position in the list.  "voices" mirrors the catalog and is rebuilt by each session.
+  #  Its string columns are untyped, so values are compared as stored (an integer never equals a
+  #  string), as in Python.
+  SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value);
+    CREATE TABLE IF NOT EXISTS voiceLists (name TEXT PRIMARY KEY);
+    CREATE TABLE IF NOT EXISTS listVoices (list TEXT NOT NULL, pos INTEGER NOT NULL, voice TEXT NOT NULL);
+    CREATE INDEX IF NOT EXISTS listVoicesPos ON listVoices (list, pos);
+    CREATE TABLE IF NOT EXISTS voices (
+      row INTEGER PRIMARY KEY, device, portNum INTEGER, name, category,
+      msb INTEGER, lsb INTEGER, pc INTEGER, voiceNum
+    );
+    CREATE INDEX IF NOT EXISTS voicesCategory ON voices (category);
+    CREATE INDEX IF NOT EXISTS voicesBank ON voices (msb, lsb, pc);
+    CREATE INDEX IF NOT EXISTS voicesDevice ON voices (device);
+    CREATE INDEX IF NOT EXISTS voicesName ON voices (name);
+  '''
+
+  ## Filter attributes that can be queried -> (column of "voices", Python type of its values).
+  #  Integer columns never hold NULL, so they also support ordering comparisons.
+  COLUMNS = {
+    'v.name': ('name', str),
+    'v.category': ('category', str),
+    'v.voiceNum': ('voiceNum', str),
+    'v.device.portName': ('device', str),
+    'v.device.portNum': ('portNum', int),
+    'v.msb': ('msb', int),
+    'v.lsb': ('lsb', int),
+    'v._pc': ('pc', int),
+  }
+
+  ## Comparison operators that can be queried -> SQL operator.
+  OPERATORS = {
+    ast.Eq: '=',
+    ast.NotEq: '!=',
+    ast.Lt: '<',
+    ast.LtE: '<=',
+    ast.Gt: '>',
+    ast.GtE: '>=',
+  }
+
+  ##
+  #  Class initializer.
+  #  @param filename Name of the database to open.  Created if it doesn't exist.  If "None", will
+  #    not be associated with a file until "load" or "save" is called.
+  #  @param catalog voicecatalog.VoiceCatalog object to answer queries over (see "File.select").
+  #  @return "None".
+  def __init__(self, filename=None, catalog=None):
+    self.catalog = catalog
+    self.catalogState = None  #(rows copied, revision) of the "voices" table.
+    self.connection = None
+    self.lock = threading.RLock()  #Serializes use of "connection".
+    self.root = None
+    self.savedLists = {}  #Name -> voice list value given to the last save.
+    super().__init__(filename)
+
+  ##
+  #  Applies the given journal entries (see synthnav.SynthNav._journalChange) to the stored voice
+  #  lists, each in its own transaction.
+  #  @param entries List of entries.
+  #  @return "None".
+  def append(self, entries):
+    with self.lock:
+      for entry in entries:
+        with self.connection:
+          self._applyEntry(*entry)
+
+  ##
+  #  Applies a single journal entry.
+  #  @param kind Kind of edit: "insert", "remove", "move" or "reset".
+  #  @param name Name of the voice list.
+  #  @param args The rest of the entry.
+  #  @return "None".
+  def _applyEntry(self, kind, name, *args):
+    execute = self.connection.execute
+    execute('INSERT OR IGNORE INTO voiceLists VALUES (?)', (name,))
+    if kind == 'insert':
+      start, keys = args
+      execute('UPDATE listVoices SET pos = pos + ? WHERE list = ? AND pos >= ?', (len(keys), name, start))
+      self._insertVoices(name, start, keys)
+    elif kind == 'remove':
+      start, count = args
+      execute('DELETE FROM listVoices WHERE list = ? AND pos >= ? AND pos < ?', (name, start, start + count))
+      execute('UPDATE listVoices SET pos = pos - ? WHERE list = ? AND pos >= ?', (count, name, start + count))
+    elif kind == 'move':
+      start, count, dest = args
+      #Voices in the moved range go to "dest"; the ones they pass over shift the other way.
+      execute(
+        '''
+        UPDATE listVoices SET pos = CASE
+          WHEN pos >= :start AND pos < :start + :count THEN pos - :start + :dest
+          WHEN :dest < :start AND pos >= :dest AND pos < :start THEN pos + :count
+          WHEN :dest > :start AND pos >= :start + :count AND pos < :dest + :count THEN pos - :count
+          ELSE pos END
+        WHERE list = :name
+        ''',
+        {'start': start, 'count': count, 'dest': dest, 'name': name},
+      )
+    elif kind == 'reset':
+      execute('DELETE FROM listVoices WHERE list = ?', (name,))
+      self._insertVoices(name, 0, args[0])
+    else:
+      raise ValueError('Unknown journal entry "{}".'.format(kind))
+
+  ##
+  #  Opens the given database, creating its schema if needed.
+  #  @param filename Path to the database.
+  #  @return "None".
+  def _connect(self, filename):
+    with self.lock:
+      if self.connection is not None:
+        self.connection.close()
+      self.connection = sqlite3.connect(filename, check_same_thread=False)
+      self.connection.executescript(self.SCHEMA)
+      self.catalogState = None
+
+  ##
+  #  Resolves the given conjunct to a query condition.
+  #  @param node ast node.
+  #  @return 2-tuple "(clause, params)" where "clause" is an SQL expression over the "voices" table
+  #    and "params" its parameters, or "(None, channels)" with the set of channels matched if the
+  #    conjunct tests "v.channel".
+  #  @throws vectorfilter.Unsupported If the conjunct can't be queried.
+  def _getCondition(self, node):
+    if not isinstance(node, ast.Compare) or len(node.ops) != 1:
+      raise vectorfilter.Unsupported()
+    attr = ast.unparse(node.left)
+    literal = vectorfilter.getLiteral(node.comparators[0])
+    op = node.ops[0]
+    if attr == 'v.channel':
+      try:
+        func = vectorfilter.OPERATORS[type(op)]
+        return None, voiceindex.getMatchingChannels(lambda channel: func(channel, literal))
+      except (KeyError, TypeError):
+        raise vectorfilter.Unsupported()
+    try:
+      column, valueType = self.COLUMNS[attr]
+    except KeyError:
+      raise vectorfilter.Unsupported()
+    isValue = lambda value: type(value) is valueType  #SQLite would coerce e.g. "'87'" to 87.
+    if isinstance(op, (ast.In, ast.NotIn)):
+      if not isinstance(literal, (list, tuple, set, frozenset)) or not all(map(isValue, literal)):
+        raise vectorfilter.Unsupported()
+      literal = list(literal)
+      clause = '{} IN ({})'.format(column, ', '.join('?' * len(literal)))
+      if isinstance(op, ast.NotIn):
+        return '({} IS NULL OR NOT {})'.format(column, clause), literal
+      return clause, literal
+    try:
+      sqlOp = self.OPERATORS[type(op)]
+    except KeyError:
+      raise vectorfilter.Unsupported()
+    if not isValue(literal) or (valueType is not int and sqlOp not in ('=', '!=')):
+      raise vectorfilter.Unsupported()
+    if sqlOp == '!=':
+      return '({0} IS NULL OR {0} != ?)'.format(column), [literal]
+    return '{} {} ?'.format(column, sqlOp), [literal]
+
+  ##
+  #  Returns the voice lists stored in the database.
+  #  @return Dictionary "{'voiceLists': {name: StoredKeys object}}" plus any other keys given to
+  #    "setRoot", or "None" if nothing has been stored.
+  def getRoot(self):
+    return self.root
+
+  ##
+  #  Returns the entries not yet applied to the stored voice lists.  Entries are applied as they're
+  #  appended, so there never are any.
+  #  @return Empty list.
+  def getEntries(self):
+    return []
+
+  ##
+  #  Returns the identity keys stored for the given voice list.
+  #  @param name Name of the voice list.
+  #  @return List of strings, in list order.
+  def getVoiceKeys(self, name):
+    with self.lock:
+      return [key for key, in self.connection.execute(
+        'SELECT voice FROM listVoices WHERE list = ? ORDER BY pos',
+        (name,),
+      )]
+
+  ##
+  #  Inserts the given voices into a list starting at the given position.
+  #  @param name Name of the voice list.
+  #  @param start Position of the first voice.
+  #  @param keys List of voice identity keys.
+  #  @return "None".
+  def _insertVoices(self, name, start, keys):
+    self.connection.executemany(
+      'INSERT INTO listVoices VALUES (?, ?, ?)',
+      ((name, pos, key) for pos, key in enumerate(keys, start)),
+    )
+
+  def _load(self, filename):
+    self._connect(filename)
+    with self.lock:
+      execute = self.connection.execute
+      root = dict(execute('SELECT key, value FROM meta'))
+      voiceLists = dict((name, StoredKeys(self, name, size)) for name, size in execute(
+        'SELECT name, COUNT(voice) FROM voiceLists LEFT JOIN listVoices ON list = name GROUP BY name'
+      ))
+    if root or voiceLists:
+      root['voiceLists'] = voiceLists
+      self.root = root
+    else:
+      self.root = None
+
+  ##
+  #  Stores the current root in place of everything in the database, in a single transaction.
+  #  Only voice lists that changed are rewritten: a list given as this database's own StoredKeys,
+  #  or as the same object given to the last save, is left as stored.
+  #  @param filename Path to save to.  If it isn't the associated database, that database is
+  #    opened (and created if needed) and becomes the associated one.
+  #  @return "None".
+  def save(self, filename=None):
+    if filename is None:
+      if self.filename is None:
+        raise ValueError('No associated filename.  One must be provided.')
+      filename = self.filename
+    voiceLists = self.root.get('voiceLists', {})
+    with self.lock:
+      if filename != self.filename or self.connection is None:
+        changed = dict((name, list(keys)) for name, keys in voiceLists.items())  #Read before switching.
+        self._connect(filename)
+        self.filename = filename
+      else:
+        changed = dict(
+          (name, keys) for name, keys in voiceLists.items()
+          if keys is not self.savedLists.get(name)
+          and not (isinstance(keys, StoredKeys) and keys.file is self and keys.name == name)
+        )
+      with self.connection:
+        execute = self.connection.execute
+        execute('DELETE FROM meta')
+        for key, value in self.root.items():
+          if key != 'voiceLists':
+            execute('INSERT INTO meta VALUES (?, ?)', (key, value))
+        for name, in execute('SELECT name FROM voiceLists').fetchall():
+          if name not in voiceLists:
+            execute('DELETE FROM voiceLists WHERE name = ?', (name,))
+            execute('DELETE FROM listVoices WHERE list = ?', (name,))
+        for name, keys in changed.items():
+          execute('INSERT OR IGNORE INTO voiceLists VALUES (?)', (name,))
+          execute('DELETE FROM listVoices WHERE list = ?', (name,))
+          self._insertVoices(name, 0, keys)
+    self.savedLists = dict(voiceLists)
+
+  ##
+  #  Narrows the given voices using the facet comparisons in the given filter, queried through the
+  #  indexes of the catalog copy.  Top-level conjuncts comparing an attribute in "COLUMNS" (or
+  #  "v.channel") to a literal are queried; the rest are returned as a residual filter.
+  #  @param voices voicecatalog.VoiceSequence object made of ChannelProduct parts (see
+  #    voiceindex.VoiceIndex.select).
+  #  @param filter Filter string.
+  #  @return 2-tuple "(voices, residual)" where "voices" is a voicecatalog.VoiceSequence and
+  #    "residual" is a filter string (or "None" if nothing is left to evaluate), or "None" if no
+  #    conjunct could be queried.
+  def select(self, voices, filter):
+    products = voiceindex.getProducts(voices.voiceIds)
+    if products is None or self.catalog is None:
+      return None
+    clauses = []
+    params = []
+    channels = None
+    residual = []
+    conjuncts = voicefilter.getConjuncts(filter)
+    for node in conjuncts:
+      if isinstance(node, ast.Constant) and node.value is True:
+        continue
+      try:
+        clause, args = self._getCondition(node)
+      except vectorfilter.Unsupported:
+        residual.append(node)
+        continue
+      if clause is None:
+        channels = args if channels is None else channels & args
+      else:
+        clauses.append(clause)
+        params.extend(args)
+    if len(residual) == len(conjuncts):
+      return None
+    rowBitmap = None
+    if clauses:
+      with self.lock:
+        self._syncCatalog()
+        rowBitmap = voiceindex.toBitmap(row for row, in self.connection.execute(
+          'SELECT row FROM voices WHERE {}'.format(' AND '.join(clauses)),
+          params,
+        ))
+    return voiceindex.narrow(self.catalog, products, rowBitmap, channels), voiceindex.joinConjuncts(residual)
+
+  ##
+  #  Sets the voice lists to store (see "File.getRoot").
+  #  @param root Dictionary.
+  #  @return "None".
+  def setRoot(self, root):
+    self.root = root
+
+  ##
+  #  Brings the "voices" table up to date with the catalog.  New rows are copied incrementally; if
+  #  existing rows were modified (or this is the first sync since opening the database), the table
+  #  is rebuilt.
+  #  @return "None".
+  def _syncCatalog(self):
+    numRows = len(self.catalog)
+    start = 0
+    if self.catalogState is not None:
+      start, revision = self.catalogState
+      if revision != self.catalog.revision:
+        start = 0
+    if self.catalogState is not None and start == numRows:
+      return
+    get = self.catalog.get
+    rows = []
+    for row in range(start, numRows):
+      device = get('device', row)
+      rows.append((
+        row, device.get_port_name(), device.portNum, get('name', row), get('category', row),
+        get('msb', row), get('lsb', row), get('pc', row), get('voiceNum', row),
+      ))
+    with self.connection:
+      if start == 0:
+        self.connection.execute('DELETE FROM voices')
+      self.connection.executemany('INSERT INTO voices VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+    self.catalogState = (numRows, self.catalog.revision)
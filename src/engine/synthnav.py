@@ -21,110 +21,360 @@
 #  Engine for the Synthesizer Navigator (SynthNav).
 
 from . import addressabletree
+from . import journalfile
 from . import mididevice
+from . import namesearch
+from . import sqlitefile
+from . import vectorfilter
+from . import voicecatalog
+from . import voicefilter
+from . import voiceindex
+from . import voicesort
 from . import yamlfile
 from PySide import QtCore
+from array import array
 from patchcorral.src.data import synthesizers
-import itertools
+import collections
+import os
 import re
+import shutil
+import threading
+import traceback
 
 
 
 
 ##
-#  Class for maintaining lists of voice objects.
+#  Returns the voice IDs of the given voices.
+#  @param voices Iterable of mididevice.MIDIVoice objects or a voicecatalog.VoiceSequence.
+#  @return Iterable of integer voice IDs.
+def _voiceIds(voices):
+  if isinstance(voices, voicecatalog.VoiceSequence):
+    return voices.voiceIds
+  return (voice.voiceId for voice in voices)
+
+##
+#  Returns the IDs of the given voices that adding them to a list would add.
+#  @param voiceIds voicecatalog.IdList object holding the list's voice IDs.
+#  @param voices Iterable of mididevice.MIDIVoice objects or a voicecatalog.VoiceSequence.
+#  @return List of integer voice IDs, in order, without the ones already in the list or repeated.
+def _newVoiceIds(voiceIds, voices):
+  seen = set()
+  ret = []
+  for vid in _voiceIds(voices):
+    if vid not in voiceIds and vid not in seen:
+      seen.add(vid)
+      ret.append(vid)
+  return ret
+
+##
+#  Describes one change to a MIDIVoiceList.
+#  "kind" is one of:
+#    "insert": "count" voices were inserted at index "start".
+#    "remove": "count" voices were removed from index "start".
+#    "move": the "count" voices at index "start" were moved so they now begin at
+#      index "dest".
+#    "reset": the whole list was replaced; "count" is the new length.
+#  For "insert" and "remove", "voiceIds" holds the IDs of the voices inserted or
+#  removed, in list order.
+ListChange = collections.namedtuple('ListChange', ('kind', 'start', 'count', 'dest', 'voiceIds'))
+
+##
+#  Class for maintaining ordered lists of distinct voices.  Only the voices' IDs
+#  in "mididevice.CATALOG" are stored (in a voicecatalog.IdList, which keeps the
+#  order voices were added in); voice objects are created as they are read.  A
+#  voicecatalog.VoiceSequence given to the list is kept as-is (so virtual
+#  sequences stay virtual) until the list is first modified.  A list loaded from
+#  the user data only reads its stored identity keys once its voices are first
+#  needed, and can be unloaded again (see "evict") as long as it's unmodified.
 class MIDIVoiceList(QtCore.QObject):
 
+  ## Emits after any change to the list.
   listModified = QtCore.Signal()
 
+  ## Emits a ListChange object right before each change is applied.
+  listAboutToChange = QtCore.Signal(object)
+
+  ## Emits a ListChange object right after each change is applied, before "listModified".
+  listChanged = QtCore.Signal(object)
+
+  ## Emits when the voices of a list created from stored keys are read.
+  listLoaded = QtCore.Signal()
+
   ##
   #  Class constructor.
   #  @param voices List of src.engine.mididevice.MIDIVoice objects.
+  #  @param keys Sized iterable of identity keys (see mididevice.MIDIVoice.identityKey) to load
+  #    the voices from when they're first needed.  If given, "voices" is ignored.
   #  @return "None".
-  def __init__(self, voices=None):
+  def __init__(self, voices=None, keys=None):
     super().__init__(None)
-    if voices is None:
-      voices = []
-    self.voiceList = set(voices)
+    self._voiceList = None
+    self.version = 0  #Incremented by each change.
+    if keys is None:
+      if voices is None:
+        voices = []
+      self.setVoices(voices, False)
+    self.keys = keys  #Stored keys matching the list's voices, or "None" once it's been changed.
 
   ##
   #  Add the given voice to the list.
   #  @param voice src.engine.mididevice.MIDIVoice object.
   #  @return "None".
   def add(self, voice):
-    self.voiceList.add(voice)
-    self.listModified.emit()
+    self.adds([voice])
 
   ##
   #  Add the given voices to the list.
   #  @param voices List of src.engine.mididevice.MIDIVoice objects.
   #  @return "None".
   def adds(self, voices):
-    self.voiceList |= set(voices)
+    voiceIds = self._getIdList()
+    added = _newVoiceIds(voiceIds, voices)
+    if added:
+      self._apply(
+        ListChange('insert', len(voiceIds), len(added), None, added), voiceIds.extend, added
+      )
+
+  ##
+  #  Applies a change to the list: emits "listAboutToChange", calls the given function to make
+  #  the change, then emits "listChanged" and "listModified".
+  #  @param change ListChange object describing the change.
+  #  @param func Function making the change.
+  #  @param args Arguments to pass to "func".
+  #  @return "None".
+  def _apply(self, change, func, *args):
+    self.listAboutToChange.emit(change)
+    func(*args)
+    self.keys = None
+    self.version += 1
+    self.listChanged.emit(change)
     self.listModified.emit()
 
   ##
   #  Removes all voices from the list.
   #  @return "None".
   def clear(self):
-    self.voiceList = set()
-    self.listModified.emit()
+    self._apply(ListChange('reset', 0, 0, None, None), self._setVoiceList, voicecatalog.IdList())
+
+  ##
+  #  Unloads the list's voices; they're read from the stored keys again when
+  #  next needed.  Only lists created from keys and not changed since can be
+  #  unloaded.
+  #  @return "True" if the voices were unloaded.
+  def evict(self):
+    if self.keys is None or self._voiceList is None:
+      return False
+    self._voiceList = None
+    return True
+
+  ##
+  #  Magic method for "voice in list".  O(1) once the list has been modified.
+  def __contains__(self, voice):
+    if isinstance(self.voiceList, voicecatalog.VoiceSequence):
+      return voice.voiceId in iter(self.voiceList.voiceIds)
+    return voice.voiceId in self.voiceList
 
   ##
   #  Enables users to reference a particular voice in the list.
   #  @param key Integer index.
   def __getitem__(self, key):
-    return list(self.voiceList)[key]
+    if isinstance(self.voiceList, voicecatalog.VoiceSequence):
+      return self.voiceList[key]
+    return mididevice.CATALOG.voice(self.voiceList[key])
 
   def __getstate__(self):
-    return self.voiceList
+    return self.getVoices()
 
   ##
   #  Returns a copy of the internal voice list.
   #  @return List of mididevice.MIDIVoice objects.
   def getVoices(self, voices=None):
-    return list(self.voiceList)
+    return list(self)
+
+  ##
+  #  Returns the internal list of voice IDs, first converting a stored sequence if needed.
+  #  @return voicecatalog.IdList object.
+  def _getIdList(self):
+    if isinstance(self.voiceList, voicecatalog.VoiceSequence):
+      self.voiceList = voicecatalog.IdList(self.voiceList.voiceIds)
+    return self.voiceList
+
+  ##
+  #  Returns the IDs of the voices in the list without copying them.
+  #  @return Sequence of integer voice IDs.
+  def getVoiceIds(self):
+    if isinstance(self.voiceList, voicecatalog.VoiceSequence):
+      return self.voiceList.voiceIds
+    return self.voiceList
+
+  ##
+  #  Returns the voices in the list as a sequence without copying a stored sequence.
+  #  A list that has been modified is copied, so later changes don't affect the
+  #  returned sequence.
+  #  @return voicecatalog.VoiceSequence object.
+  def getVoiceSequence(self):
+    if isinstance(self.voiceList, voicecatalog.VoiceSequence):
+      return self.voiceList
+    return mididevice.CATALOG.voices(array('I', self.voiceList))
+
+  ##
+  #  Returns the list's voices, first reading them from the stored keys if needed.
+  #  @return voicecatalog.IdList object or voicecatalog.VoiceSequence.
+  def _getVoiceList(self):
+    if self._voiceList is None:
+      with mididevice.bindDevices() as binder:
+        self._voiceList = voicecatalog.IdList(
+          mididevice.internIdentityKey(key, binder).voiceId for key in self.keys
+        )
+      self.listLoaded.emit()
+    return self._voiceList
+
+  ##
+  #  Returns the position of the given voice in the list.
+  #  @param voice src.engine.mididevice.MIDIVoice object.
+  #  @throws ValueError If the voice isn't in the list.
+  #  @return Integer index.
+  def index(self, voice):
+    return self._getIdList().index(voice.voiceId)
+
+  ##
+  #  Inserts the given voices before the given position, in order.  Voices already
+  #  in the list are left where they are.
+  #  @param idx Integer index.
+  #  @param voices Any number of src.engine.mididevice.MIDIVoice objects.
+  #  @return "None".
+  def insert(self, idx, *voices):
+    voiceIds = self._getIdList()
+    start = max(0, min(idx, len(voiceIds)))
+    added = _newVoiceIds(voiceIds, voices)
+    if added:
+      self._apply(
+        ListChange('insert', start, len(added), None, added), self._insertIds, start, added
+      )
+
+  ##
+  #  Inserts the given voice IDs, none of which are in the list, before the given position.
+  #  @param idx Integer index.
+  #  @param voiceIds List of integer voice IDs.
+  #  @return "None".
+  def _insertIds(self, idx, voiceIds):
+    for offset, vid in enumerate(voiceIds):
+      self.voiceList.insert(idx + offset, vid)
 
   ##
   #  Iterates over the voice list.  This is what gets called by
   #  "for ... in ...".
   #  @return Iterator object.
   def __iter__(self):
-    return iter(self.voiceList)
+    if isinstance(self.voiceList, voicecatalog.VoiceSequence):
+      return iter(self.voiceList)
+    return iter(mididevice.CATALOG.voices(self.voiceList))
 
   ##
   #  Returns an iterator that, as it is iterated, will apply the current voice
   #  by calling it's "pc" method.
   #  @return Iterator object.
   def iterPC(self):
-    for voice in self.voiceList:
+    for voice in self:
       voice.pc()
       yield voice
 
   ##
-  #  Magic method for getting the length of the list.
+  #  Checks whether the list's voices are in memory.
+  #  @return "False" if the list hasn't been read from its stored keys yet, or was evicted.
+  def isLoaded(self):
+    return self._voiceList is not None
+
+  ##
+  #  Magic method for getting the length of the list.  Doesn't load the list.
   def __len__(self):
-    return len(self.voiceList)
+    if self._voiceList is None:
+      return len(self.keys)
+    return len(self._voiceList)
 
   ##
-  #  Removes the given voice from the list.
+  #  Moves a range of voices within the list.
+  #  @param start Index of the first voice to move.
+  #  @param count Number of voices to move.
+  #  @param dest Index the voices should begin at once moved.
+  #  @throws IndexError If either range doesn't fit in the list.
+  #  @return "None".
+  def move(self, start, count, dest):
+    voiceIds = self._getIdList()
+    if start < 0 or dest < 0 or max(start, dest) + count > len(voiceIds):
+      raise IndexError('Cannot move {} voices from {} to {}.'.format(count, start, dest))
+    if count == 0 or start == dest:
+      return
+    moved = voiceIds[start:start + count]
+    self._apply(ListChange('move', start, count, dest, None), self._moveIds, moved, dest)
+
+  ##
+  #  Moves the given voice IDs so they begin at the given position.
+  #  @param voiceIds Sequence of integer voice IDs in the list.
+  #  @param dest Index the voices should begin at once moved.
+  #  @return "None".
+  def _moveIds(self, voiceIds, dest):
+    for vid in voiceIds:
+      self.voiceList.remove(vid)
+    for offset, vid in enumerate(voiceIds):
+      self.voiceList.insert(dest + offset, vid)
+
+  ##
+  #  Removes the given voices from the list.  Each run of adjacent voices is
+  #  reported as a single "remove" change, starting from the end of the list.
   #  @param voices Any number of src.engine.mididevice.MIDIVoice objects.
+  #  @throws ValueError If a voice isn't in the list (nothing is removed).
   #  @return "None".
   def remove(self, *voices):
-    for voice in voices:
-      self.voiceList.remove(voice)
+    voiceIds = self._getIdList()
+    changes = []
+    for idx in sorted(set(voiceIds.index(voice.voiceId) for voice in voices), reverse=True):
+      if changes and changes[-1].start == idx + 1:
+        changes[-1] = changes[-1]._replace(start=idx, count=changes[-1].count + 1)
+      else:
+        changes.append(ListChange('remove', idx, 1, None, None))
+    if len(changes) == 0:
+      return
+    self.keys = None
+    self.version += 1
+    for change in changes:
+      change = change._replace(voiceIds=list(voiceIds[change.start:change.start + change.count]))
+      self.listAboutToChange.emit(change)
+      for vid in change.voiceIds:
+        voiceIds.remove(vid)
+      self.listChanged.emit(change)
     self.listModified.emit()
 
   def __setstate__(self, state):
-    self.voiceList = state
+    self.version = 0
+    self.setVoices(state, False)
 
   ##
   #  Sets the internal voice list to the given list.
-  #  @param voices List of mididevice.MIDIVoice objects.
+  #  @param voices List of mididevice.MIDIVoice objects or a voicecatalog.VoiceSequence.
+  #  @param notify If "True", will emit "listModified".
   #  @return "None".
-  def setVoices(self, voices):
-    self.voiceList = set(voices)
-    self.listModified.emit()
+  def setVoices(self, voices, notify=True):
+    if not isinstance(voices, voicecatalog.VoiceSequence):
+      voices = voicecatalog.IdList(_voiceIds(voices))
+    if notify:
+      self._apply(ListChange('reset', 0, len(voices), None, None), self._setVoiceList, voices)
+    else:
+      self.voiceList = voices
+      self.keys = None
+      self.version += 1
+
+  ##
+  #  Sets the list's voices.
+  #  @param voiceList voicecatalog.IdList object or voicecatalog.VoiceSequence.
+  #  @return "None".
+  def _setVoiceList(self, voiceList):
+    self._voiceList = voiceList
+
+  ## The list's voices: a voicecatalog.IdList or voicecatalog.VoiceSequence.  Reading it loads a
+  #  list created from stored keys.
+  voiceList = property(_getVoiceList, _setVoiceList)
 
 ##
 #  Class for navigating voices within a single synthesizer.  Supports generation
@@ -135,6 +385,42 @@ class SynthNav(QtCore.QObject):
   ## Emits when the user has changed the voice filter.  Emits the new filter string.
   filterChanged = QtCore.Signal(str)
 
+  ## Emits when a filter requested with "filterAsync" fails.  Emits the filter string and the
+  #  error message.
+  filterFailed = QtCore.Signal(str, str)
+
+  ## Emits when a name search has been applied to the filtered list.  Emits the search text.
+  searchChanged = QtCore.Signal(str)
+
+  ## Emits "(generation, revision, filter, result)" from the filter thread.  Handled on the Qt
+  #  thread by "_onFilterDone".
+  _filterDone = QtCore.Signal(object)
+
+  ## Milliseconds to wait for more keystrokes before evaluating a typed filter.
+  FILTER_DELAY = 300
+
+  ## Milliseconds to wait for more list changes before saving the user data.
+  SAVE_DELAY = 1000
+
+  ## Version of the user data format written by "saveUserData".  Version 2 stores each voice as
+  #  its identity key "<portName> <msb> <lsb> <pc> <channel>" (see mididevice.MIDIVoice.identityKey)
+  #  instead of a full MIDIVoice object; the catalog supplies the rest on load.  Version 3 adds the
+  #  name, category and voiceNum to the keys of patches the catalog can't supply.  Files without a
+  #  version hold MIDIVoice objects.  Older files are copied to "<file>.v<version>.bak", then
+  #  rewritten in the current format when loaded.
+  USERDATA_VERSION = 3
+
+  ## Number of journaled list edits after which the user data is compacted into a new snapshot.
+  JOURNAL_LIMIT = 1000
+
+  ## Extensions of user data files stored as SQLite databases (see sqlitefile.File) rather than
+  #  as YAML with a journal (see journalfile.File).
+  SQLITE_EXTENSIONS = ('.db', '.sqlite')
+
+  ## Number of voices that unmodified user lists may keep loaded.  Beyond it, the least recently
+  #  used lists are unloaded (see MIDIVoiceList.evict).
+  VOICE_LIST_BUDGET = 100000
+
   ## Dictionary of voice lists with names as keys and MIDIVoiceList objects as values.
   voiceLists = None
 
@@ -146,9 +432,32 @@ class SynthNav(QtCore.QObject):
     self.midiInDevs = None
     self.midiOutDevs = None
     self.currFilter = None
+    self.currFilterResult = None  #Voices "currFilter" selected from "fullVoiceList".
     self.userdataFile = None
     self.userdata = None
     self.voiceLists = None
+    self.voiceIndex = voiceindex.VoiceIndex(mididevice.CATALOG)
+    self.nameIndex = namesearch.TrigramIndex(mididevice.CATALOG)
+    self.sortIndex = voicesort.SortIndex(mididevice.CATALOG)
+    self.filterGeneration = 0  #Incremented by each filter request; older requests are dropped.
+    self.filterLock = mididevice.CATALOG.lock  #Held while the catalog changes or another thread reads it.
+    self.pendingFilter = None
+    self.filterTimer = QtCore.QTimer(self)
+    self.filterTimer.setSingleShot(True)
+    self.filterTimer.timeout.connect(self._startFilter)
+    self._filterDone.connect(self._onFilterDone)
+    self.saveGeneration = 0  #Incremented by each save request.
+    self.savedGeneration = 0  #Generation of the last snapshot written.
+    self.saveLock = threading.Lock()  #Held while the user data file is written.
+    self.saveThread = None  #Last thread started by "_startSave".
+    self.pendingEntries = []  #Journal entries not yet handed to a save thread.
+    self.journalLength = 0  #Entries journaled since the last snapshot.
+    self.loadedLists = collections.OrderedDict()  #Names of evictable loaded lists, least recently used first.
+    self.listSections = {}  #Name -> (MIDIVoiceList, version, saved value) of the last snapshot written.
+    self.subscriptions = {}  #Name -> (MIDIVoiceList, slots) connected by "_subscribeVoiceList".
+    self.saveTimer = QtCore.QTimer(self)
+    self.saveTimer.setSingleShot(True)
+    self.saveTimer.timeout.connect(self._startSave)
     #Call initialization functions.
     self.refreshMIDIDevices()
     self.loadUserData(userdataFileName)
@@ -175,35 +484,117 @@ class SynthNav(QtCore.QObject):
   #  @post "filtered" voice list will be repopulated.
   def filter(self, filter=None, voices=None):
     if filter is not None:
+      self._cancelFilter()
       self.newVoiceList(filter, 'filtered', voices)
     return self.currFilter
 
+  ##
+  #  Applies the given filter to the "filtered" voice list on a separate thread.
+  #  A newer request (or a call to "filter") cancels this one, and the list is
+  #  replaced all at once, on the Qt thread, when the newest request finishes.
+  #  Errors are reported through "filterFailed".
+  #  @param filter String with a Python expression.  See "SynthNav.filter".
+  #  @param delay Milliseconds to wait before starting.  Each request restarts
+  #    the wait, so a burst of requests (e.g. keystrokes) only evaluates the last.
+  #  @return "None".
+  def filterAsync(self, filter, delay=0):
+    self._cancelFilter()
+    self.pendingFilter = filter
+    if delay > 0:
+      self.filterTimer.start(delay)
+    else:
+      self._startFilter()
+
+  ##
+  #  Cancels any pending or running "filterAsync" request.
+  #  @return "None".
+  def _cancelFilter(self):
+    self.filterGeneration += 1
+    self.pendingFilter = None
+    self.filterTimer.stop()
+
+  ##
+  #  Body of the filter thread.  "fullVoiceList" and "currFilterResult" are
+  #  immutable sequences, and the catalog (and its indexes) only change while
+  #  holding its lock, which is held here for the whole evaluation, so the voices
+  #  being filtered can't change underneath it.
+  #  @param generation Value of "filterGeneration" when the request was made.
+  #  @param filter Filter string that was requested.
+  #  @param selectFilter Filter string to evaluate.
+  #  @param voices voicecatalog.VoiceSequence object to evaluate it over.
+  #  @return "None".
+  def _filter(self, generation, filter, selectFilter, voices):
+    cancelled = lambda: generation != self.filterGeneration
+    try:
+      with self.filterLock:
+        revision = mididevice.CATALOG.revision
+        result = self.select(selectFilter, voices, cancelled)
+    except vectorfilter.Cancelled:
+      return
+    except Exception as e:
+      if not isinstance(e, (SyntaxError, ValueError)):  #Not just a mistyped filter.
+        traceback.print_exc()
+      if not cancelled():
+        self.filterFailed.emit(filter, str(e))
+      return
+    self._filterDone.emit((generation, revision, filter, result))
+
+  ##
+  #  Writes any pending changes to the user data file now, and waits for saves
+  #  already in progress to finish.  Call before exiting.
+  #  @return "None".
+  def flushUserData(self):
+    if self.saveTimer.isActive():
+      self.saveTimer.stop()
+      self._startSave()
+    if self.saveThread is not None:
+      self.saveThread.join()
+
+  ##
+  #  Returns the (msb, lsb) banks of the voices in the filtered list.
+  #  @return Set of 2-tuples.
+  def getCurrBanks(self):
+    return self.voiceIndex.getValues('bank', self._getFilteredVoices())
+
   def getCurrCategories(self):
-    return set(x.category for x in self.voiceLists['filtered'])
+    return self.voiceIndex.getValues('category', self._getFilteredVoices())
 
   def getCurrChannels(self):
-    return set(x.channel for x in self.voiceLists['filtered'])
+    return self.voiceIndex.getChannels(self._getFilteredVoices())
 
   def getCurrFilter(self):
     return self.currFilter
 
+  ##
+  #  Counts the voices in the filtered list by facet.  Computed in one pass and cached until the
+  #  filtered list changes.
+  #  @return Dictionary mapping "category", "channel", "portName", "msb", "lsb", "pc" and "bank"
+  #    to dictionaries of value -> number of voices.
+  def getFacetCounts(self):
+    counts = dict(self.voiceIndex.getCounts(self._getFilteredVoices()))
+    portNames = {}
+    for device, count in counts.pop('device').items():
+      portNames[device.portName] = portNames.get(device.portName, 0) + count
+    counts['portName'] = portNames
+    return counts
+
   def getCurrLSBs(self):
-    return set(x.lsb for x in self.voiceLists['filtered'])
+    return self.voiceIndex.getValues('lsb', self._getFilteredVoices())
 
   def getCurrMidiOutDevPortNames(self):
-    return set(x.device.portName for x in self.voiceLists['filtered'])
+    return set(x.portName for x in self.voiceIndex.getValues('device', self._getFilteredVoices()))
 
   def getCurrMidiOutDevPortNums(self):
-    return set(x.device.portNum for x in self.voiceLists['filtered'])
+    return set(x.portNum for x in self.voiceIndex.getValues('device', self._getFilteredVoices()))
 
   def getCurrMSBs(self):
-    return set(x.msb for x in self.voiceLists['filtered'])
+    return self.voiceIndex.getValues('msb', self._getFilteredVoices())
 
   def getCurrPCs(self):
-    return set(x._pc for x in self.voiceLists['filtered'])
+    return self.voiceIndex.getValues('pc', self._getFilteredVoices())
 
   def getCurrVoiceNums(self):
-    return set(x.voiceNum for x in self.voiceLists['filtered'])
+    return self.voiceIndex.getValues('voiceNum', self._getFilteredVoices())
 
   ##
   #  Returns the voices that are currently available from the filtered list.
@@ -211,6 +602,55 @@ class SynthNav(QtCore.QObject):
   def getFilteredVoiceList(self):
     return self.voiceLists['filtered']
 
+  ##
+  #  Returns the part of the given filter that still needs to be evaluated over the current
+  #  filtered list, if the filter only narrows the current one.
+  #  @param filter Filter string.
+  #  @return Filter string, or "None" if the full voice list has to be filtered again.
+  def _getRefinement(self, filter):
+    if self.currFilterResult is None:
+      return None
+    if self.voiceLists['filtered'].voiceList is not self.currFilterResult:  #Modified since.
+      return None
+    return voicefilter.getRefinement(self.currFilter, filter)
+
+  ##
+  #  Publishes the result of a filter thread if it is still the newest request.
+  #  @param done 4-tuple "(generation, revision, filter, result)".
+  #  @return "None".
+  def _onFilterDone(self, done):
+    generation, revision, filter, result = done
+    if generation != self.filterGeneration:
+      return
+    if revision != mididevice.CATALOG.revision:  #Voices were edited meanwhile; start over.
+      self.filterAsync(filter)
+      return
+    self.voiceLists['filtered'].setVoices(result)
+    self.currFilter = filter
+    self.currFilterResult = result
+    self.filterChanged.emit(filter)
+
+  ##
+  #  Captures the user data to save.  Called on the Qt thread; only the voice IDs
+  #  are copied, so the voice objects can be built by the saving thread.  Lists
+  #  unchanged since they were loaded are captured as their stored keys, so they
+  #  don't have to be loaded.
+  #  @return Dictionary mapping each saved list's name to a 3-tuple
+  #    "(MIDIVoiceList, version, voices)" where "voices" is a
+  #    voicecatalog.VoiceSequence object or a sized iterable of identity keys.
+  def _getUserDataSnapshot(self):
+    return dict(
+      (k, (v, v.version, v.keys if v.keys is not None else v.getVoiceSequence()))
+      for k, v in self.userdata['voiceLists'].items()
+      if k not in ('all', 'queued', 'filtered')
+    )
+
+  ##
+  #  Returns the voices of the filtered list as a sequence.
+  #  @return voicecatalog.VoiceSequence object.
+  def _getFilteredVoices(self):
+    return self.voiceLists['filtered'].getVoiceSequence()
+
   ##
   #  Returns the currently-available MIDI output devices.
   #  @return A list of MIDIOutDevice objects.
@@ -223,12 +663,14 @@ class SynthNav(QtCore.QObject):
   #    "filtered", "all", and "queued" (uses "all" by default).
   #  @return MIDIVoiceList object.
   def getVoiceList(self, name='all'):
+    if name in self.loadedLists:
+      self.loadedLists.move_to_end(name)
     return self.voiceLists[name]
 
   ##
   #  Returns an iterator that steps over the voices.  Supports filtering.
   #  @param filter Python statement that can be evaluated such that "v" stands for a MIDIVoice
-  #    object.
+  #    object.  See voicefilter.parseFilter for what the statement may contain.
   #  @param voices Optional list of voices to filter.  If "None", will use the unfiltered master
   #    list.
   #  @return Iterator object that returns MIDIVoice objects.
@@ -237,24 +679,63 @@ class SynthNav(QtCore.QObject):
       voiceList = self.fullVoiceList
     else:
       voiceList = voices
-    d = {}
-    exec('def f(v): return {}'.format(filter), d)
-    f = d['f']
+    f = voicefilter.compileFilter(filter)
     for v in voiceList:
       if f(v):
         yield v
         
+  ##
+  #  Journals the given change to the named voice list and schedules it to be saved.
+  #  @param name Name of the voice list.
+  #  @param change ListChange object.
+  #  @return "None".
+  def _journalChange(self, name, change):
+    voiceList = self.voiceLists[name]
+    if change.kind == 'insert':
+      keys = [mididevice.CATALOG.voice(vid).identityKey for vid in change.voiceIds]
+      entry = ['insert', name, change.start, keys]
+    elif change.kind == 'remove':
+      entry = ['remove', name, change.start, change.count]
+    elif change.kind == 'move':
+      entry = ['move', name, change.start, change.count, change.dest]
+    else:
+      entry = ['reset', name, [voice.identityKey for voice in voiceList]]
+    self.pendingEntries.append(entry)
+    self.scheduleSave()
+
+  ##
+  #  Loads the user data from the given file, migrating it to the current format
+  #  if needed.
+  #  @param userdataFileName Path to the user data file.  Created if it doesn't exist.
+  #  @return "None".
   def loadUserData(self, userdataFileName):
-    self.userdataFile = yamlfile.File(userdataFileName)
-    userdata = self.userdataFile.getRoot()  #Note that any modifications to this will modify
-                                            #the internal structure of "userdataFile".
-    self.userdata = {'voiceLists': {}}
-    if userdata is not None and 'voiceLists' in userdata:
-      for k, v in userdata['voiceLists'].items():
-        self.userdata['voiceLists'][k] = MIDIVoiceList(v)
-    if 'favorites' not in self.userdata['voiceLists']:
-      self.userdata['voiceLists']['favorites'] = MIDIVoiceList()
-    self.voiceLists = self.userdata['voiceLists']
+    with mididevice.bindDevices() as binder:  #Resolves each device name once for the whole file.
+      if os.path.splitext(userdataFileName)[1].lower() in self.SQLITE_EXTENSIONS:
+        self.userdataFile = sqlitefile.File(userdataFileName, mididevice.CATALOG)
+      else:
+        self.userdataFile = journalfile.File(userdataFileName)
+      userdata = self.userdataFile.getRoot()  #Note that any modifications to this will modify
+                                              #the internal structure of "userdataFile".
+      self.userdata = {'voiceLists': {}}
+      migrate = userdata is None  #A new file is stamped with the current format right away.
+      if userdata is not None and 'voiceLists' in userdata:
+        version = userdata.get('version', 1)
+        for k, v in userdata['voiceLists'].items():
+          if version >= 2:
+            self.userdata['voiceLists'][k] = MIDIVoiceList(keys=v)  #Loaded when first used.
+          else:
+            self.userdata['voiceLists'][k] = MIDIVoiceList(v)
+        migrate = version < self.USERDATA_VERSION
+        if migrate:
+          shutil.copy2(userdataFileName, '{}.v{}.bak'.format(userdataFileName, version))
+      if 'favorites' not in self.userdata['voiceLists']:
+        self.userdata['voiceLists']['favorites'] = MIDIVoiceList()
+      self.voiceLists = self.userdata['voiceLists']
+      for entry in self.userdataFile.getEntries():
+        self._replayEntry(entry, binder)
+      self.journalLength = len(self.userdataFile.getEntries())
+    if migrate:
+      self.saveUserData()
 
   ##
   #  Creates a new voice list using the given filter.
@@ -264,41 +745,157 @@ class SynthNav(QtCore.QObject):
   #    given name.  If the name is already being use by another list, this
   #    method will populate that existing list with the new voices.
   #  @param voices List of voices to use as the unfiltered data.  If "None",
-  #    will use the unfiltered master voice list.
+  #    will use the unfiltered master voice list.  For the "filtered" list,
+  #    a filter that only adds conjuncts to the current one is evaluated over
+  #    the current results instead.
   #  @return "None".
   def newVoiceList(self, filter='True', name=None, voices=None):
-    if voices is None:
-      voices = self.fullVoiceList
+    selectFilter = filter
+    selectVoices = voices
+    if selectVoices is None:
+      selectVoices = self.fullVoiceList
+      if name == 'filtered':
+        refinement = self._getRefinement(filter)
+        if refinement is not None:
+          selectFilter, selectVoices = refinement, self.currFilterResult
+    result = self.select(selectFilter, selectVoices)
     try:
       ret = self.voiceLists[name]
     except KeyError:
-      ret = MIDIVoiceList(self.iter(filter, voices))
+      ret = MIDIVoiceList(result)
       if name is not None:
         assert isinstance(ret, MIDIVoiceList)
         self.voiceLists[name] = ret
     else:
-      ret.setVoices(self.iter(filter, voices))
+      ret.setVoices(result)
     if name == 'filtered':  #Do this at the end so listeners get the updated voice list as well.
       self.currFilter = filter
+      self.currFilterResult = result if voices is None else None
       self.filterChanged.emit(filter)
     return ret
 
+  ##
+  #  Callback for when a user list is read from its stored keys.  Marks it most
+  #  recently used, then unloads the least recently used lists until the loaded
+  #  lists fit "VOICE_LIST_BUDGET".  The list just loaded is always kept.
+  #  @param name Name of the voice list.
+  #  @return "None".
+  def _onVoiceListLoaded(self, name):
+    self.loadedLists[name] = None
+    self.loadedLists.move_to_end(name)
+    for loadedName in list(self.loadedLists):
+      if self.voiceLists.get(loadedName) is None or self.voiceLists[loadedName].keys is None:
+        del self.loadedLists[loadedName]  #Changed since loaded, so it can't be unloaded.
+    total = sum(len(self.voiceLists[loadedName]) for loadedName in self.loadedLists)
+    for loadedName in list(self.loadedLists):
+      if total <= self.VOICE_LIST_BUDGET or loadedName == name:
+        break
+      voiceList = self.voiceLists[loadedName]
+      total -= len(voiceList)
+      voiceList.evict()
+      del self.loadedLists[loadedName]
+
   ##
   #  Refreshes the internal list of available MIDI devices.
   #  @return "None".
   def refreshMIDIDevices(self):
+    self._cancelFilter()
     self.midiInDevs = mididevice.getMIDIInDevices()
     midiOutDevs = mididevice.getMIDIOutDevices()
-    self.midiOutDevs = list((synthesizers.getMIDIOutDevice(dev[0], dev[1]) for dev in midiOutDevs))
-    self.fullVoiceList = list((itertools.chain(*(x.getVoiceList() for x in self.midiOutDevs))))
+    with self.filterLock:
+      self.midiOutDevs = list((synthesizers.getMIDIOutDevice(dev[0], dev[1]) for dev in midiOutDevs))
+      self.fullVoiceList = mididevice.CATALOG.voices(voicecatalog.IdChain(
+        x.getVoiceList().voiceIds for x in self.midiOutDevs
+      ))
+      self.voiceIndex.update()
+    self.currFilterResult = None
+
+  ##
+  #  Applies a journal entry (see "_journalChange") to the voice lists.
+  #  @param entry List.
+  #  @param binder mididevice.DeviceBinder object.
+  #  @return "None".
+  def _replayEntry(self, entry, binder):
+    kind, name, args = entry[0], entry[1], entry[2:]
+    if kind == 'reset':
+      voices = [mididevice.internIdentityKey(key, binder) for key in args[0]]
+      try:
+        self.voiceLists[name].setVoices(voices, False)
+      except KeyError:
+        self.voiceLists[name] = MIDIVoiceList(voices)
+      return
+    voiceList = self.voiceLists[name]
+    if kind == 'insert':
+      voiceList.insert(args[0], *(mididevice.internIdentityKey(key, binder) for key in args[1]))
+    elif kind == 'remove':
+      voiceList.remove(*(voiceList[idx] for idx in range(args[0], args[0] + args[1])))
+    elif kind == 'move':
+      voiceList.move(*args)
+    else:
+      raise ValueError('Unknown journal entry "{}".'.format(kind))
+
+  ##
+  #  Replaces the contents of the filtered list with the voices matching the current filter whose
+  #  name or voice number fuzzily matches the given text, best matches first.  The current filter
+  #  is left unchanged.
+  #  @param text String to search for.  If empty, the filtered list is restored to every voice
+  #    matching the current filter.
+  #  @param limit Maximum number of patches to return.  If "None", returns all matches.
+  #  @return "None".
+  def search(self, text, limit=None):
+    voices = self.currFilterResult
+    if voices is None:
+      voices = self.select(self.currFilter if self.currFilter is not None else 'True')
+    if namesearch.normalize(text):
+      voices = namesearch.rankVoices(voices, self.nameIndex.search(text), limit)
+    self.voiceLists['filtered'].setVoices(voices)
+    self.searchChanged.emit(text)
 
+  ##
+  #  Returns the voices matching the given filter.  An unfiltered sequence is returned as-is so
+  #  that virtual sequences (such as the per-channel expansion of each device's patches) are
+  #  never materialized.
+  #  @param filter Python statement that can be evaluated such that "v" stands for a MIDIVoice
+  #    object.
+  #  @param voices Optional list of voices to filter.  If "None", will use the unfiltered master
+  #    list.
+  #  @param cancelled Optional function returning "True" once the result is no longer wanted (see
+  #    vectorfilter.select).
+  #  @return voicecatalog.VoiceSequence object.
+  def select(self, filter='True', voices=None, cancelled=None):
+    if voices is None:
+      voices = self.fullVoiceList
+    elif not isinstance(voices, voicecatalog.VoiceSequence):
+      voices = mididevice.CATALOG.voices(_voiceIds(voices))
+    if filter == 'True':
+      return voices
+    if isinstance(self.userdataFile, sqlitefile.File):
+      indexed = self.userdataFile.select(voices, filter)
+    else:
+      indexed = self.voiceIndex.select(voices, filter)
+    if indexed is not None:
+      voices, filter = indexed
+      if filter is None:
+        return voices
+    return vectorfilter.select(voices, filter, cancelled)
+
+  ##
+  #  Saves a snapshot of the user data to file now, replacing any scheduled save
+  #  and emptying the journal.
+  #  @return "None".
   def saveUserData(self):
-    userdata = {'voiceLists': {}}
-    for k, v in self.userdata['voiceLists'].items():
-      if k not in ('all', 'queued', 'filtered'):
-        userdata['voiceLists'][k] = list(v)
-    self.userdataFile.setRoot(userdata)
-    self.userdataFile.save()
+    self.saveTimer.stop()
+    self.saveGeneration += 1
+    self.pendingEntries = []
+    self.journalLength = 0
+    self._writeUserData(self.saveGeneration, [], self._getUserDataSnapshot())
+
+  ##
+  #  Schedules the user data to be saved in the background once no further
+  #  changes arrive for "SAVE_DELAY" milliseconds.
+  #  @return "None".
+  def scheduleSave(self):
+    self.saveTimer.start(self.SAVE_DELAY)
 
   ##
   #  Stores the given voice list to the given name.
@@ -308,6 +905,9 @@ class SynthNav(QtCore.QObject):
   def saveVoiceList(self, name, voices):
     assert isinstance(voices, MIDIVoiceList)
     self.voiceLists[name] = voices
+    if name not in ('all', 'queued', 'filtered'):
+      self._subscribeVoiceList(name, voices)
+      self._journalChange(name, ListChange('reset', 0, len(voices), None, None))
 
   ##
   #  Applies the given voice.
@@ -316,7 +916,137 @@ class SynthNav(QtCore.QObject):
   def selectVoice(self, voice):
     voice.pc()
 
+  ##
+  #  Starts a thread evaluating "pendingFilter".  Whatever reads mutable state
+  #  (the refinement against the current results, the index update) is done
+  #  here, on the Qt thread.
+  #  @return "None".
+  def _startFilter(self):
+    filter, self.pendingFilter = self.pendingFilter, None
+    if filter is None:
+      return
+    try:
+      refinement = self._getRefinement(filter)
+    except (SyntaxError, ValueError) as e:
+      self.filterFailed.emit(filter, str(e))
+      return
+    if refinement is None:
+      selectFilter, voices = filter, self.fullVoiceList
+    else:
+      selectFilter, voices = refinement, self.currFilterResult
+    self.voiceIndex.update()
+    thread = threading.Thread(
+      target=self._filter,
+      args=(self.filterGeneration, filter, selectFilter, voices),
+    )
+    thread.daemon = True
+    thread.start()
+
+  ##
+  #  Starts a thread appending the pending journal entries to the user data file,
+  #  along with a snapshot once the journal has grown past "JOURNAL_LIMIT".  Each
+  #  thread waits for the previous one, so entries are written in order.  The
+  #  threads aren't daemons, so exiting waits for the writes to complete.
+  #  @return "None".
+  def _startSave(self):
+    entries, self.pendingEntries = self.pendingEntries, []
+    self.journalLength += len(entries)
+    snapshot = None
+    if self.journalLength > self.JOURNAL_LIMIT and isinstance(self.userdataFile, journalfile.File):
+      snapshot = self._getUserDataSnapshot()
+      self.journalLength = 0
+    self.saveGeneration += 1
+    previous = self.saveThread
+    self.saveThread = threading.Thread(
+      target=self._writeUserData,
+      args=(self.saveGeneration, entries, snapshot, previous),
+    )
+    self.saveThread.start()
+
+  ##
+  #  Connects the given user voice list's changes to the journal, first disconnecting any list
+  #  previously subscribed under the same name.
+  #  @param name Name of the voice list.
+  #  @param voiceList MIDIVoiceList object.
+  #  @return "None".
+  def _subscribeVoiceList(self, name, voiceList):
+    self._unsubscribeVoiceList(name)
+    slots = (
+      (voiceList.listChanged, lambda change: self._journalChange(name, change)),
+      (voiceList.listLoaded, lambda: self._onVoiceListLoaded(name)),
+    )
+    for signal, slot in slots:
+      signal.connect(slot)
+    self.subscriptions[name] = (voiceList, slots)
+
   def subscribeVoiceLists(self):
     for name, voiceList in self.voiceLists.items():
       if name not in ('all', 'queued', 'filtered'):
-        voiceList.listModified.connect(self.saveUserData)
+        self._subscribeVoiceList(name, voiceList)
+
+  ##
+  #  Disconnects the voice list subscribed under the given name, if any (see
+  #  "_subscribeVoiceList").
+  #  @param name Name of the voice list.
+  #  @return "None".
+  def _unsubscribeVoiceList(self, name):
+    try:
+      voiceList, slots = self.subscriptions.pop(name)
+    except KeyError:
+      return
+    for signal, slot in slots:
+      signal.disconnect(slot)
+
+  ##
+  #  Returns a snapshot's voice lists in the form stored by the user data file.
+  #  Only lists changed since the last snapshot written are converted again: for
+  #  a YAML file they're kept as pre-serialized yamlfile.Section objects, and the
+  #  SQLite store skips lists still holding their stored keys.
+  #  @param snapshot Return value of "_getUserDataSnapshot".
+  #  @return Dictionary.
+  def _getSavedVoiceLists(self, snapshot):
+    ret = {}
+    sections = {}
+    for k, (voiceList, version, voices) in snapshot.items():
+      try:
+        savedList, savedVersion, value = self.listSections[k]
+      except KeyError:
+        savedList = None
+      if savedList is not voiceList or savedVersion != version:
+        if isinstance(voices, voicecatalog.VoiceSequence):
+          voices = [voice.identityKey for voice in voices]
+        if isinstance(self.userdataFile, journalfile.File):
+          value = yamlfile.Section(k, list(voices))
+        else:
+          value = voices
+      ret[k] = value
+      sections[k] = (voiceList, version, value)
+    self.listSections = sections
+    return ret
+
+  ##
+  #  Writes journal entries and/or a snapshot of the user data to file.  Writes
+  #  requested before the last snapshot written are dropped, as it includes them.
+  #  @param generation Value of "saveGeneration" when the write was requested.
+  #  @param entries List of journal entries to append.
+  #  @param snapshot Return value of "_getUserDataSnapshot", or "None" to only
+  #    append the entries.
+  #  @param previous Thread to wait for first, or "None".
+  #  @return "None".
+  def _writeUserData(self, generation, entries, snapshot, previous=None):
+    if previous is not None:
+      previous.join()
+    with self.saveLock:
+      if generation < self.savedGeneration:
+        return
+      if entries:
+        self.userdataFile.append(entries)
+      if snapshot is not None:
+        with self.filterLock:
+          userdata = {
+            'version': self.USERDATA_VERSION,
+            'voiceLists': self._getSavedVoiceLists(snapshot),
+          }
+        self.userdataFile.setRoot(userdata)
+        self.userdataFile.save()
+        self.savedGeneration = generation
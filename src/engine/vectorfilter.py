@@ -0,0 +1,289 @@
+####################################################################################################
+# Copyright 2013 John Crawford
+#
+# This file is part of PatchCorral.
+#
+# PatchCorral is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PatchCorral is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PatchCorral.  If not, see <http://www.gnu.org/licenses/>.
+####################################################################################################
+
+## @file
+#  Evaluates voice filters as boolean-mask operations over the columns of a
+#  voicecatalog.VoiceCatalog instead of calling a predicate once per voice.
+#
+#  Each comparison between a voice attribute and a literal (e.g. "v.category in ['BASS']" or
+#  "v.msb >= 87") is evaluated once per distinct value in the attribute's column (its intern table,
+#  or 0-255 for the numeric columns) to build a lookup table, which is then indexed by the column's
+#  codes.  Conjuncts that can't be translated are evaluated per voice, but only over the voices
+#  that survive the translated ones.  NumPy is optional; without it every filter is evaluated per
+#  voice.
+
+from . import voicecatalog
+from . import voicefilter
+from array import array
+import ast
+import functools
+import operator
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+
+
+## Maps MIDIVoice attributes to catalog columns ("None" means the channel packed in the voice ID).
+ATTRIBUTES = {
+  'name': 'name',
+  'device': 'device',
+  'channel': None,
+  'msb': 'msb',
+  'lsb': 'lsb',
+  '_pc': 'pc',
+  'category': 'category',
+  'voiceNum': 'voiceNum',
+}
+
+## Number of voices evaluated per-voice between checks for cancellation.
+CHUNK_SIZE = 4096
+
+## Comparison operators that can be translated.
+OPERATORS = {
+  ast.Eq: operator.eq,
+  ast.NotEq: operator.ne,
+  ast.Lt: operator.lt,
+  ast.LtE: operator.le,
+  ast.Gt: operator.gt,
+  ast.GtE: operator.ge,
+  ast.In: lambda a, b: a in b,
+  ast.NotIn: lambda a, b: a not in b,
+  ast.Is: operator.is_,
+  ast.IsNot: operator.is_not,
+}
+
+##
+#  Raised by "select" when its "cancelled" function reports that the result is no longer wanted.
+class Cancelled(Exception):
+  pass
+
+##
+#  Raised when part of a filter can't be translated into mask operations.
+class Unsupported(Exception):
+  pass
+
+##
+#  Holds the vectorized voices being filtered and the per-voice column codes derived from them.
+class _Context():
+
+  ##
+  #  Class initializer.
+  #  @param catalog voicecatalog.VoiceCatalog object.
+  #  @param voiceIds numpy array of voice IDs.
+  #  @return "None".
+  def __init__(self, catalog, voiceIds):
+    self.catalog = catalog
+    self.voiceIds = voiceIds
+    self.rows = voiceIds >> voicecatalog.CHANNEL_BITS
+    self.codes = {None: voiceIds & ((1 << voicecatalog.CHANNEL_BITS) - 1)}
+
+  ##
+  #  Returns the codes of the given column for each voice.
+  #  @param column Column name, or "None" for the channel.
+  #  @return numpy array.
+  def getCodes(self, column):
+    try:
+      return self.codes[column]
+    except KeyError:
+      codes = self.codes[column] = _getColumn(self.catalog, column)[self.rows]
+      return codes
+
+  ##
+  #  Returns the values that the codes of the given column decode to, indexed by code.
+  #  @param column Column name, or "None" for the channel.
+  #  @return Sequence.
+  def getValues(self, column):
+    try:
+      return self.catalog.tables[column].values
+    except KeyError:
+      return range(256)
+
+##
+#  Returns the given voice IDs whose voices match the given predicate, checking for cancellation
+#  between chunks.
+#  @param catalog voicecatalog.VoiceCatalog object.
+#  @param voiceIds Sequence of voice IDs.
+#  @param predicate Function taking a MIDIVoice object.
+#  @param cancelled Function returning "True" if evaluation should stop, or "None".
+#  @throws Cancelled If "cancelled" returned "True".
+#  @return array of voice IDs.
+def _evaluate(catalog, voiceIds, predicate, cancelled):
+  voice = catalog.voice
+  ret = array('I')
+  for start in range(0, len(voiceIds), CHUNK_SIZE):
+    if cancelled is not None and cancelled():
+      raise Cancelled()
+    ret.extend(vid for vid in voiceIds[start:start + CHUNK_SIZE] if predicate(voice(vid)))
+  return ret
+
+##
+#  Returns a vectorized copy of the given catalog column, cached until the catalog changes.
+#  @param catalog voicecatalog.VoiceCatalog object.
+#  @param column Column name.
+#  @return numpy array.
+def _getColumn(catalog, column):
+  key = ('numpy', column)
+  try:
+    return catalog.cache[key]
+  except KeyError:
+    ret = catalog.cache[key] = numpy.array(catalog.columns[column])
+    return ret
+
+##
+#  Returns a vectorized copy of the given sequence's voice IDs, cached on the sequence.
+#  @param voices voicecatalog.VoiceSequence object.
+#  @return numpy array of voice IDs.
+def _getVoiceIds(voices):
+  try:
+    return voices.cache['numpy']
+  except KeyError:
+    ret = voices.cache['numpy'] = _toNumpy(voices.voiceIds)
+    return ret
+
+##
+#  Helper function for "_getVoiceIds".  Builds virtual sequences without iterating them.
+#  @param voiceIds Sequence of voice IDs.
+#  @return numpy array of voice IDs.
+def _toNumpy(voiceIds):
+  if isinstance(voiceIds, voicecatalog.IdChain):
+    parts = [_toNumpy(part) for part in voiceIds.parts]
+    return numpy.concatenate(parts) if parts else numpy.zeros(0, numpy.uint32)
+  if isinstance(voiceIds, voicecatalog.ChannelProduct):
+    rows = numpy.array(voiceIds.rows, numpy.uint32)
+    channels = numpy.array(voiceIds.channels, numpy.uint32)
+    return (numpy.tile(rows, len(channels)) << voicecatalog.CHANNEL_BITS) | numpy.repeat(channels, len(rows))
+  if isinstance(voiceIds, voicecatalog.IdList):
+    parts = [numpy.array(block, numpy.uint32) for block in voiceIds.blocks]
+    return numpy.concatenate(parts)
+  return numpy.array(voiceIds, numpy.uint32)
+
+##
+#  Resolves the given node to a voice attribute.
+#  @param node ast node.
+#  @return 2-tuple "(column, decode)" where "decode" maps a decoded column value to the value of
+#    the attribute.
+#  @throws Unsupported If the node isn't an attribute of "v" backed by a column.
+def getAttribute(node):
+  path = []
+  while isinstance(node, ast.Attribute):
+    path.insert(0, node.attr)
+    node = node.value
+  if not isinstance(node, ast.Name) or node.id != 'v' or len(path) == 0 or path[0] not in ATTRIBUTES:
+    raise Unsupported()
+  column = ATTRIBUTES[path[0]]
+  if len(path) == 1:
+    return column, None
+  if column != 'device':
+    raise Unsupported()
+  return column, operator.attrgetter('.'.join(path[1:]))
+
+##
+#  Resolves the given node to a literal.
+#  @param node ast node.
+#  @return Python object.
+#  @throws Unsupported If the node isn't a literal.
+def getLiteral(node):
+  try:
+    return ast.literal_eval(node)
+  except ValueError:
+    raise Unsupported()
+
+##
+#  Translates a single comparison between an attribute and a literal into a mask.
+#  @param left ast node.
+#  @param op ast comparison operator.
+#  @param right ast node.
+#  @param ctx _Context object.
+#  @return numpy array of booleans.
+def _compare(left, op, right, ctx):
+  try:
+    func = OPERATORS[type(op)]
+  except KeyError:
+    raise Unsupported()
+  try:
+    (column, decode), literal = getAttribute(left), getLiteral(right)
+    test = lambda value: func(value, literal)
+  except Unsupported:
+    (column, decode), literal = getAttribute(right), getLiteral(left)
+    test = lambda value: func(literal, value)
+  values = ctx.getValues(column)
+  try:
+    if decode is None:
+      lut = numpy.fromiter((bool(test(value)) for value in values), bool, len(values))
+    else:
+      lut = numpy.fromiter((bool(test(decode(value))) for value in values), bool, len(values))
+  except Exception:
+    raise Unsupported()
+  return lut[ctx.getCodes(column)]
+
+##
+#  Translates the given filter node into a mask.
+#  @param node ast node.
+#  @param ctx _Context object.
+#  @return numpy array of booleans.
+#  @throws Unsupported If the node can't be translated.
+def _mask(node, ctx):
+  if isinstance(node, ast.BoolOp):
+    masks = [_mask(value, ctx) for value in node.values]
+    reduce = numpy.logical_and if isinstance(node.op, ast.And) else numpy.logical_or
+    return functools.reduce(reduce, masks)
+  if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+    return ~_mask(node.operand, ctx)
+  if isinstance(node, ast.Constant):
+    return numpy.full(len(ctx.voiceIds), bool(node.value))
+  if isinstance(node, ast.Compare):
+    operands = [node.left] + node.comparators
+    masks = [_compare(operands[i], op, operands[i + 1], ctx) for i, op in enumerate(node.ops)]
+    return functools.reduce(numpy.logical_and, masks)
+  raise Unsupported()
+
+##
+#  Returns the voices in the given sequence that match the given filter.
+#  @param voices voicecatalog.VoiceSequence object.
+#  @param filter String with a Python expression such that "v" stands for a MIDIVoice object.
+#  @param cancelled Optional function that returns "True" once the result is no longer wanted.
+#    Checked between steps and every "CHUNK_SIZE" voices evaluated one by one.
+#  @throws SyntaxError If the filter isn't a valid Python expression.
+#  @throws ValueError If the filter uses syntax or names that aren't allowed.
+#  @throws Cancelled If "cancelled" returned "True".
+#  @return voicecatalog.VoiceSequence object.
+def select(voices, filter, cancelled=None):
+  catalog = voices.catalog
+  if numpy is None:
+    predicate = voicefilter.compileFilter(filter)
+    return catalog.voices(_evaluate(catalog, array('I', voices.voiceIds), predicate, cancelled))
+  ctx = _Context(catalog, _getVoiceIds(voices))
+  masks = []
+  residual = []
+  for node in voicefilter.getConjuncts(filter):
+    try:
+      masks.append(_mask(node, ctx))
+    except Unsupported:
+      residual.append(node)
+  voiceIds = ctx.voiceIds
+  if masks:
+    voiceIds = voiceIds[functools.reduce(numpy.logical_and, masks)]
+  ret = array('I')
+  ret.frombytes(voiceIds.astype(numpy.uint32).tobytes())
+  if residual:
+    predicate = voicefilter.compileFilter(' and '.join('({})'.format(ast.unparse(node)) for node in residual))
+    ret = _evaluate(catalog, ret, predicate, cancelled)
+  return catalog.voices(ret)
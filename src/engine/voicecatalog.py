@@ -0,0 +1,600 @@
+﻿####################################################################################################
+# Copyright 2013 John Crawford
+#
+# This file is part of PatchCorral.
+#
+# PatchCorral is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PatchCorral is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PatchCorral.  If not, see <http://www.gnu.org/licenses/>.
+####################################################################################################
+
+## @file
+#  Columnar storage for the voices offered by MIDI devices.  Patches are kept as rows of parallel
+#  typed arrays instead of one Python object each, and each patch is stored once no matter how
+#  many channels it can be played on.  A voice is a (row, channel) pair packed into an integer
+#  "voice ID"; MIDIVoice objects are thin views onto one.
+
+from array import array
+import bisect
+import threading
+
+
+
+## Number of low bits of a voice ID that hold the channel.
+CHANNEL_BITS = 5
+
+##
+#  Packs the given row and channel into a voice ID.
+#  @param row Integer catalog row.
+#  @param channel MIDI channel (0-16).
+#  @return Integer voice ID.
+def voiceId(row, channel):
+  return (row << CHANNEL_BITS) | channel
+
+##
+#  Unpacks the given voice ID.
+#  @param voiceId Integer voice ID.
+#  @return 2-tuple "(row, channel)".
+def splitVoiceId(voiceId):
+  return voiceId >> CHANNEL_BITS, voiceId & ((1 << CHANNEL_BITS) - 1)
+
+##
+#  Maps values to compact integer codes (and back) so columns only need to store the codes.
+class InternTable():
+
+  ##
+  #  Class initializer.
+  #  @param keyFunc Function mapping a value to the dictionary key used to intern it.  If "None",
+  #    the value itself is used.  Use "id" for objects that should be interned by identity.
+  #  @return "None".
+  def __init__(self, keyFunc=None):
+    self.keyFunc = keyFunc
+    self.values = []
+    self.codes = {}
+
+  ##
+  #  Returns the value stored under the given code.
+  #  @param code Integer code returned by "intern".
+  #  @return Interned value.
+  def __getitem__(self, code):
+    return self.values[code]
+
+  ##
+  #  Returns the code for the given value, adding the value to the table if needed.
+  #  @param value Value to intern.
+  #  @return Integer code.
+  def intern(self, value):
+    key = value if self.keyFunc is None else self.keyFunc(value)
+    try:
+      return self.codes[key]
+    except KeyError:
+      code = len(self.values)
+      self.values.append(value)
+      self.codes[key] = code
+      return code
+
+  def __len__(self):
+    return len(self.values)
+
+##
+#  Columnar catalog of MIDI patches.  Each patch is a row across the parallel arrays in
+#  "self.columns"; string and device columns hold codes into the matching "self.tables" entry.
+#  The channel is not stored; it is part of the voice ID used to look a voice up.
+class VoiceCatalog():
+
+  ## Type codes of the catalog's columns.
+  COLUMNS = {
+    'name': 'I',
+    'device': 'H',
+    'msb': 'B',
+    'lsb': 'B',
+    'pc': 'B',
+    'category': 'H',
+    'voiceNum': 'I',
+  }
+
+  ##
+  #  Class initializer.
+  #  @param voiceClass Class used to view rows of this catalog (see "VoiceCatalog.voice").
+  #  @return "None".
+  def __init__(self, voiceClass):
+    self.voiceClass = voiceClass
+    ## Held while the catalog is changed, and by other threads while they read it.
+    self.lock = threading.RLock()
+    self.columns = dict((column, array(typecode)) for column, typecode in self.COLUMNS.items())
+    ## Derived data (e.g. vectorized copies of the columns).  Cleared whenever the catalog changes.
+    self.cache = {}
+    ## Incremented whenever an existing row is modified (adding rows doesn't count).
+    self.revision = 0
+    self.tables = {
+      'name': InternTable(),
+      'device': InternTable(id),
+      'category': InternTable(),
+      'voiceNum': InternTable(),
+    }
+    ## (device code, msb, lsb, pc) -> first row holding that patch.  See "VoiceCatalog.findRow".
+    self.patchRows = {}
+    self.patchRowsState = (0, 0)  #(rows indexed, revision) of "patchRows".
+    ## Rows added one at a time by "addPatch" (patches no device's banks offer).
+    self.extraRows = set()
+
+  ##
+  #  Adds a compiled bank of patches to the catalog (see bankfile.File).  Each distinct string is
+  #  interned once rather than once per patch.
+  #  @param device MIDIOutDevice object the patches belong to.
+  #  @param bank Object with "getColumn(field)", returning an array for each of "name", "msb",
+  #    "lsb", "pc", "category" and "voiceNum", and "strings", the list the string columns index.
+  #  @param channels Sequence of MIDI channels the patches can be played on.
+  #  @return VoiceSequence object covering the new patches on every channel.
+  def addBank(self, device, bank, channels):
+    with self.lock:
+      start = len(self)
+      self.cache.clear()
+      for column in ('msb', 'lsb', 'pc'):
+        self.columns[column].extend(bank.getColumn(column))
+      count = len(self.columns['msb']) - start
+      deviceCode = self.tables['device'].intern(device)
+      self.columns['device'].extend(array('H', (deviceCode,)) * count)
+      for column in ('name', 'category', 'voiceNum'):
+        indexes = bank.getColumn(column)
+        table = self.tables[column]
+        codes = dict((i, table.intern(bank.strings[i])) for i in dict.fromkeys(indexes))
+        self.columns[column].extend(array(self.COLUMNS[column], map(codes.__getitem__, indexes)))
+      return VoiceSequence(self, ChannelProduct(range(start, len(self)), channels))
+
+  ##
+  #  Adds a single patch to the catalog.
+  #  @param name String
+  #  @param device MIDIOutDevice object
+  #  @param msb Most Significant Bit
+  #  @param lsb Least Significant Bit
+  #  @param pc Program Change value
+  #  @param category Category of the voice
+  #  @param voiceNum Number of the voice as displayed on the device
+  #  @return Integer row of the new patch.
+  def addPatch(self, name, device, msb, lsb, pc, category=None, voiceNum=None):
+    with self.lock:
+      row = len(self)
+      for column, value in (
+        ('name', name),
+        ('device', device),
+        ('msb', msb),
+        ('lsb', lsb),
+        ('pc', pc),
+        ('category', category),
+        ('voiceNum', voiceNum),
+      ):
+        self.set(column, row, value, True)
+      self.extraRows.add(row)
+      return row
+
+  ##
+  #  Adds a bank of patches to the catalog.  Each patch is stored once; the returned sequence
+  #  expands it over the given channels on demand.
+  #  @param device MIDIOutDevice object the patches belong to.
+  #  @param patches Iterable of 6-tuples "(name, msb, lsb, pc, category, voiceNum)".
+  #  @param channels Sequence of MIDI channels the patches can be played on.
+  #  @return VoiceSequence object covering the new patches on every channel.
+  def addVoices(self, device, patches, channels):
+    with self.lock:
+      patches = list(patches)
+      start = len(self)
+      self.cache.clear()
+      deviceCode = self.tables['device'].intern(device)
+      self.columns['name'].extend(self.tables['name'].intern(p[0]) for p in patches)
+      self.columns['device'].extend(array('H', (deviceCode,)) * len(patches))
+      self.columns['msb'].extend(p[1] for p in patches)
+      self.columns['lsb'].extend(p[2] for p in patches)
+      self.columns['pc'].extend(p[3] for p in patches)
+      self.columns['category'].extend(self.tables['category'].intern(p[4]) for p in patches)
+      self.columns['voiceNum'].extend(self.tables['voiceNum'].intern(p[5]) for p in patches)
+      return VoiceSequence(self, ChannelProduct(range(start, len(self)), channels))
+
+  ##
+  #  Returns the row holding the patch selected by the given device, bank and program.  This is
+  #  the patch part of a voice's canonical identity (see mididevice.MIDIVoice.identity).
+  #  @param device MIDIOutDevice object.
+  #  @param msb Most Significant Bit
+  #  @param lsb Least Significant Bit
+  #  @param pc Program Change value
+  #  @return Integer row, or "None" if no row matches.
+  def findRow(self, device, msb, lsb, pc):
+    with self.lock:
+      deviceCode = self.tables['device'].codes.get(id(device))
+      if deviceCode is None:
+        return None
+      numRows, revision = self.patchRowsState
+      if revision != self.revision:
+        self.patchRows = {}
+        numRows = 0
+      if numRows != len(self):
+        columns = self.columns
+        keys = zip(
+          columns['device'][numRows:],
+          columns['msb'][numRows:],
+          columns['lsb'][numRows:],
+          columns['pc'][numRows:],
+        )
+        for row, key in enumerate(keys, numRows):
+          self.patchRows.setdefault(key, row)
+        self.patchRowsState = (len(self), self.revision)
+      return self.patchRows.get((deviceCode, msb, lsb, pc))
+
+  ##
+  #  Returns the value of the given column for the given row.
+  #  @param column Column name (see "VoiceCatalog.COLUMNS").
+  #  @param row Integer row.
+  #  @return Decoded value.
+  def get(self, column, row):
+    code = self.columns[column][row]
+    table = self.tables.get(column)
+    if table is None:
+      return code
+    return table.values[code]
+
+  def __len__(self):
+    return len(self.columns['name'])
+
+  ##
+  #  Stores the given value in the given column for the given row.
+  #  @param column Column name (see "VoiceCatalog.COLUMNS").
+  #  @param row Integer row.
+  #  @param value Value to store.
+  #  @param append If "True", "row" must be the end of the column and the value will be appended.
+  #  @return "None".
+  def set(self, column, row, value, append=False):
+    with self.lock:
+      self.cache.clear()
+      try:
+        table = self.tables[column]
+      except KeyError:
+        code = value
+      else:
+        code = table.intern(value)
+      if append:
+        self.columns[column].append(code)
+      else:
+        self.columns[column][row] = code
+        self.revision += 1
+
+  ##
+  #  Returns a view of the given voice.
+  #  @param voiceId Integer voice ID.
+  #  @return Object of type "self.voiceClass".
+  def voice(self, voiceId):
+    row, channel = splitVoiceId(voiceId)
+    return self.voiceClass.fromCatalog(self, row, channel)
+
+  ##
+  #  Returns a lazy sequence of views over the given voices.
+  #  @param voiceIds Iterable of integer voice IDs.  Sequences such as "ChannelProduct" and
+  #    "IdChain" are used as-is; anything else is copied into an array.
+  #  @return VoiceSequence object.
+  def voices(self, voiceIds):
+    if not isinstance(voiceIds, (array, ChannelProduct, IdChain, IdList)):
+      voiceIds = array('I', voiceIds)
+    return VoiceSequence(self, voiceIds)
+
+##
+#  Virtual sequence of the voice IDs formed by pairing every row with every channel, ordered
+#  channel-major.  Nothing is stored per pair.
+class ChannelProduct():
+
+  ##
+  #  Class initializer.
+  #  @param rows Sequence of integer rows.
+  #  @param channels Sequence of MIDI channels.
+  #  @return "None".
+  def __init__(self, rows, channels):
+    self.rows = rows
+    self.channels = channels
+
+  def __getitem__(self, idx):
+    if idx < 0:
+      idx += len(self)
+    if not 0 <= idx < len(self):
+      raise IndexError('Index {} is out of range.'.format(idx))
+    channel, row = divmod(idx, len(self.rows))
+    return voiceId(self.rows[row], self.channels[channel])
+
+  def __iter__(self):
+    for channel in self.channels:
+      for row in self.rows:
+        yield (row << CHANNEL_BITS) | channel
+
+  def __len__(self):
+    return len(self.rows) * len(self.channels)
+
+##
+#  Virtual sequence of voice IDs formed by concatenating other voice ID sequences.
+class IdChain():
+
+  ##
+  #  Class initializer.
+  #  @param parts List of voice ID sequences.
+  #  @return "None".
+  def __init__(self, parts):
+    self.parts = list(parts)
+
+  def __getitem__(self, idx):
+    if idx < 0:
+      idx += len(self)
+    for part in self.parts:
+      if 0 <= idx < len(part):
+        return part[idx]
+      idx -= len(part)
+    raise IndexError('Index is out of range.')
+
+  def __iter__(self):
+    for part in self.parts:
+      yield from part
+
+  def __len__(self):
+    return sum(len(part) for part in self.parts)
+
+##
+#  Mutable, insertion-ordered sequence of distinct voice IDs.  IDs are kept in blocks of at most
+#  "2 * BLOCK_SIZE" entries, with a dictionary from each ID to its block, so membership tests are
+#  O(1) and inserting or removing an ID only shifts the entries of one block.  A Fenwick tree of
+#  the block lengths, plus the index of each block, make positional access and finding an ID's
+#  position O(log(number of blocks)).  Blocks that shrink are merged with a neighbour.
+class IdList():
+
+  ## Target number of IDs per block.
+  BLOCK_SIZE = 512
+
+  ##
+  #  Class initializer.
+  #  @param voiceIds Iterable of integer voice IDs.  Repeated IDs are only kept once.
+  #  @return "None".
+  def __init__(self, voiceIds=()):
+    self.blocks = [array('I')]
+    self.blockOf = {}
+    self.tree = None  #Fenwick tree of the block lengths; "None" until needed.
+    self.blockIdxs = None  #"id" of each block -> its index in "blocks"; rebuilt with "tree".
+    self.extend(voiceIds)
+
+  ##
+  #  Adds the given amount to the length recorded for the given block.
+  #  @param blockIdx Integer index into "self.blocks".
+  #  @param delta Integer.
+  #  @return "None".
+  def _addLength(self, blockIdx, delta):
+    tree = self.tree
+    if tree is None:
+      return
+    i = blockIdx + 1
+    while i < len(tree):
+      tree[i] += delta
+      i += i & -i
+
+  ##
+  #  Appends the given voice ID if it isn't in the list yet.
+  #  @param voiceId Integer voice ID.
+  #  @return "True" if the ID was added.
+  def append(self, voiceId):
+    return self.insert(len(self), voiceId)
+
+  def __contains__(self, voiceId):
+    return voiceId in self.blockOf
+
+  ##
+  #  Appends the given voice IDs that aren't in the list yet, in order.
+  #  @param voiceIds Iterable of integer voice IDs.
+  #  @return List of the IDs that were added.
+  def extend(self, voiceIds):
+    added = []
+    blockOf = self.blockOf
+    block = self.blocks[-1]
+    for vid in voiceIds:
+      if vid in blockOf:
+        continue
+      if len(block) >= self.BLOCK_SIZE:
+        block = array('I')
+        self.blocks.append(block)
+      block.append(vid)
+      blockOf[vid] = block
+      added.append(vid)
+    if added:
+      self.tree = None
+    return added
+
+  ##
+  #  Returns the block holding the given position.
+  #  @param idx Integer index, in range.
+  #  @return Tuple "(index into self.blocks, index of the block's first ID)".
+  def _findBlock(self, idx):
+    tree = self._getTree()
+    blockIdx = 0
+    offset = 0
+    step = 1 << (len(tree) - 1).bit_length()
+    while step:
+      i = blockIdx + step
+      if i < len(tree) and offset + tree[i] <= idx:
+        blockIdx = i
+        offset += tree[i]
+      step >>= 1
+    return blockIdx, offset
+
+  def __getitem__(self, idx):
+    if isinstance(idx, slice):
+      return array('I', (self[i] for i in range(*idx.indices(len(self)))))
+    if idx < 0:
+      idx += len(self)
+    if not 0 <= idx < len(self):
+      raise IndexError('Index {} is out of range.'.format(idx))
+    blockIdx, offset = self._findBlock(idx)
+    return self.blocks[blockIdx][idx - offset]
+
+  ##
+  #  Returns the position of the given block in "self.blocks".
+  #  @param block array object.
+  #  @return Integer index.
+  def _getBlockIdx(self, block):
+    self._getTree()
+    try:
+      return self.blockIdxs[id(block)]
+    except KeyError:
+      raise ValueError('Block is not in the list.')
+
+  ##
+  #  Returns the index of the first ID of the given block.
+  #  @param blockIdx Integer index into "self.blocks".
+  #  @return Integer index.
+  def _getOffset(self, blockIdx):
+    tree = self._getTree()
+    offset = 0
+    i = blockIdx
+    while i > 0:
+      offset += tree[i]
+      i -= i & -i
+    return offset
+
+  ##
+  #  Returns the Fenwick tree of the block lengths, rebuilding it (and the block indexes) if the
+  #  blocks were split, merged or appended to in bulk.
+  #  @return List of integers; entry "i" covers blocks "i - (i & -i)" to "i - 1".
+  def _getTree(self):
+    if self.tree is None:
+      tree = [0]
+      tree.extend(len(block) for block in self.blocks)
+      for i in range(1, len(tree)):
+        parent = i + (i & -i)
+        if parent < len(tree):
+          tree[parent] += tree[i]
+      self.tree = tree
+      self.blockIdxs = dict((id(block), idx) for idx, block in enumerate(self.blocks))
+    return self.tree
+
+  ##
+  #  Returns the position of the given voice ID.
+  #  @param voiceId Integer voice ID.
+  #  @throws ValueError If the ID isn't in the list.
+  #  @return Integer index.
+  def index(self, voiceId):
+    try:
+      block = self.blockOf[voiceId]
+    except KeyError:
+      raise ValueError('Voice ID {} is not in the list.'.format(voiceId))
+    return self._getOffset(self._getBlockIdx(block)) + block.index(voiceId)
+
+  ##
+  #  Inserts the given voice ID before the given position if it isn't in the list yet.
+  #  @param idx Integer index.  Values past the end append.
+  #  @param voiceId Integer voice ID.
+  #  @return "True" if the ID was added.
+  def insert(self, idx, voiceId):
+    if voiceId in self.blockOf:
+      return False
+    idx = max(0, min(idx, len(self)))
+    if idx > 0:
+      blockIdx, offset = self._findBlock(idx - 1)  #Prefer growing the end of the previous block.
+    else:
+      blockIdx, offset = 0, 0
+    block = self.blocks[blockIdx]
+    block.insert(idx - offset, voiceId)
+    self.blockOf[voiceId] = block
+    if len(block) > 2 * self.BLOCK_SIZE:
+      tail = block[self.BLOCK_SIZE:]
+      del block[self.BLOCK_SIZE:]
+      for vid in tail:
+        self.blockOf[vid] = tail
+      self.blocks.insert(blockIdx + 1, tail)
+      self.tree = None
+    else:
+      self._addLength(blockIdx, 1)
+    return True
+
+  def __iter__(self):
+    for block in self.blocks:
+      yield from block
+
+  def __len__(self):
+    return len(self.blockOf)
+
+  ##
+  #  Appends the given block's successor to it and drops the successor.
+  #  @param blockIdx Integer index into "self.blocks".
+  #  @return "None".
+  def _mergeBlocks(self, blockIdx):
+    block = self.blocks[blockIdx]
+    successor = self.blocks.pop(blockIdx + 1)
+    block.extend(successor)
+    for vid in successor:
+      self.blockOf[vid] = block
+    self.tree = None
+
+  ##
+  #  Removes the given voice ID.  If its block can then be combined with a neighbour without
+  #  exceeding "BLOCK_SIZE", the two are merged.
+  #  @param voiceId Integer voice ID.
+  #  @throws ValueError If the ID isn't in the list.
+  #  @return Integer index the ID was at.
+  def remove(self, voiceId):
+    try:
+      block = self.blockOf.pop(voiceId)
+    except KeyError:
+      raise ValueError('Voice ID {} is not in the list.'.format(voiceId))
+    blockIdx = self._getBlockIdx(block)
+    pos = block.index(voiceId)
+    idx = self._getOffset(blockIdx) + pos
+    del block[pos]
+    self._addLength(blockIdx, -1)
+    blocks = self.blocks
+    if len(block) == 0 and len(blocks) > 1:
+      del blocks[blockIdx]
+      self.tree = None
+    elif blockIdx + 1 < len(blocks) and len(block) + len(blocks[blockIdx + 1]) <= self.BLOCK_SIZE:
+      self._mergeBlocks(blockIdx)
+    elif blockIdx > 0 and len(blocks[blockIdx - 1]) + len(block) <= self.BLOCK_SIZE:
+      self._mergeBlocks(blockIdx - 1)
+    return idx
+
+##
+#  Read-only sequence of voices backed by a VoiceCatalog.  Voice views are only created as they
+#  are accessed.
+class VoiceSequence():
+
+  ##
+  #  Class initializer.
+  #  @param catalog VoiceCatalog object.
+  #  @param voiceIds Sequence of integer voice IDs.
+  #  @return "None".
+  def __init__(self, catalog, voiceIds):
+    self.catalog = catalog
+    self.voiceIds = voiceIds
+    ## Derived data (e.g. a vectorized copy of "voiceIds").
+    self.cache = {}
+
+  def __getitem__(self, key):
+    return self.catalog.voice(self.voiceIds[key])
+
+  def __iter__(self):
+    catalog = self.catalog
+    fromCatalog = catalog.voiceClass.fromCatalog
+    mask = (1 << CHANNEL_BITS) - 1
+    return (fromCatalog(catalog, v >> CHANNEL_BITS, v & mask) for v in self.voiceIds)
+
+  def __len__(self):
+    return len(self.voiceIds)
+
+##
+#  Builds a property exposing a catalog column on a view class.  The view must provide "catalog"
+#  and "row" attributes.
+#  @param column Column name (see "VoiceCatalog.COLUMNS").
+#  @return Property object.
+def columnProperty(column):
+  def fget(self):
+    return self.catalog.get(column, self.row)
+  def fset(self, value):
+    self.catalog.set(column, self.row, value)
+  return property(fget, fset)
@@ -0,0 +1,179 @@
+####################################################################################################
+# Copyright 2013 John Crawford
+#
+# This file is part of PatchCorral.
+#
+# PatchCorral is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PatchCorral is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PatchCorral.  If not, see <http://www.gnu.org/licenses/>.
+####################################################################################################
+
+## @file
+#  Compiles user-defined voice filters (Python expressions in which "v" stands for a MIDIVoice
+#  object) into reusable predicates.  Filters are parsed once, checked against a whitelist of
+#  syntax, and cached by their normalized text.
+
+import ast
+import functools
+import re
+
+
+
+## Number of compiled filters to keep around.
+CACHE_SIZE = 64
+
+## Names (other than "v" and comprehension variables) that filters may reference.
+NAMES = {
+  're': re,
+  'abs': abs,
+  'all': all,
+  'any': any,
+  'bool': bool,
+  'float': float,
+  'int': int,
+  'len': len,
+  'list': list,
+  'max': max,
+  'min': min,
+  'set': set,
+  'sorted': sorted,
+  'str': str,
+  'tuple': tuple,
+}
+
+## Methods that filters may call (e.g. "v.name.startswith('A')" or "re.search(...)").
+METHODS = {
+  'casefold',
+  'count',
+  'endswith',
+  'find',
+  'fullmatch',
+  'lower',
+  'match',
+  'search',
+  'startswith',
+  'strip',
+  'upper',
+}
+
+## Syntax that filters may use.
+NODES = (
+  ast.Expression,
+  ast.BoolOp, ast.And, ast.Or,
+  ast.UnaryOp, ast.Not, ast.USub, ast.UAdd,
+  ast.BinOp, ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod,
+  ast.Compare, ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE, ast.In, ast.NotIn, ast.Is,
+  ast.IsNot,
+  ast.IfExp,
+  ast.Call, ast.keyword,
+  ast.Attribute, ast.Subscript, ast.Slice,
+  ast.Name, ast.Load, ast.Store,
+  ast.Constant,
+  ast.List, ast.Tuple, ast.Set,
+  ast.GeneratorExp, ast.ListComp, ast.SetComp, ast.comprehension,
+)
+
+##
+#  Parses the given filter and checks it against the whitelist.
+#  @param filter String with a Python expression.
+#  @throws SyntaxError If the filter isn't a valid Python expression.
+#  @throws ValueError If the filter uses syntax or names that aren't allowed.
+#  @return ast.Expression object.
+def parseFilter(filter):
+  tree = ast.parse(filter.strip(), '<filter>', 'eval')
+  names = set(NAMES)
+  names.add('v')
+  for node in ast.walk(tree):
+    if isinstance(node, ast.comprehension):
+      names.update(n.id for n in ast.walk(node.target) if isinstance(n, ast.Name))
+  for node in ast.walk(tree):
+    if not isinstance(node, NODES):
+      raise ValueError('Filter "{}" uses unsupported syntax "{}".'.format(filter, type(node).__name__))
+    if isinstance(node, ast.Name) and node.id not in names:
+      raise ValueError('Filter "{}" uses unknown name "{}".'.format(filter, node.id))
+    if isinstance(node, ast.Attribute) and node.attr.startswith('__'):
+      raise ValueError('Filter "{}" uses private attribute "{}".'.format(filter, node.attr))
+    if isinstance(node, ast.Call):
+      func = node.func
+      if isinstance(func, ast.Name):
+        allowed = func.id in NAMES
+      else:
+        allowed = isinstance(func, ast.Attribute) and func.attr in METHODS
+      if not allowed:
+        raise ValueError('Filter "{}" makes a call that isn\'t allowed: "{}".'.format(
+          filter,
+          ast.unparse(func),
+        ))
+  return tree
+
+##
+#  Splits the given filter into its top-level conjuncts.
+#  @param filter String with a Python expression.
+#  @return List of ast nodes.
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def getConjuncts(filter):
+  body = parseFilter(filter).body
+  if isinstance(body, ast.BoolOp) and isinstance(body.op, ast.And):
+    return list(body.values)
+  return [body]
+
+##
+#  Checks whether the new filter only narrows the old one, i.e. it keeps every conjunct of the old
+#  filter and adds more ("old and ...").  If so, the voices matching "new" are exactly the voices
+#  matching "old" that also match the returned filter.
+#  @param old Filter string.
+#  @param new Filter string.
+#  @return Filter string with the added conjuncts ("True" if there are none), or "None" if "new"
+#    isn't a refinement of "old".
+def getRefinement(old, new):
+  added = [ast.unparse(node) for node in getConjuncts(new)]
+  for term in (ast.unparse(node) for node in getConjuncts(old)):
+    if term == 'True':
+      continue
+    try:
+      added.remove(term)
+    except ValueError:
+      return None
+  added = [term for term in added if term != 'True']
+  if not added:
+    return 'True'
+  return ' and '.join('({})'.format(term) for term in added)
+
+##
+#  Returns the normalized text of the given filter.  Filters that only differ in formatting
+#  normalize to the same text.
+#  @param filter String with a Python expression.
+#  @return String.
+def normalizeFilter(filter):
+  return ast.unparse(parseFilter(filter))
+
+##
+#  Compiles the given filter into a predicate.  Results are cached, so re-applying a recent filter
+#  doesn't compile it again.
+#  @param filter String with a Python expression such that "v" stands for a MIDIVoice object.
+#  @throws SyntaxError If the filter isn't a valid Python expression.
+#  @throws ValueError If the filter uses syntax or names that aren't allowed.
+#  @return Function taking a MIDIVoice object and returning a truthy value if it matches.
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def compileFilter(filter):
+  return _compileNormalized(normalizeFilter(filter))
+
+##
+#  Helper function for "compileFilter".  Cached separately so differently-formatted spellings of a
+#  filter share one predicate.
+#  @param filter Normalized filter string (see "normalizeFilter").
+#  @return Predicate function.
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def _compileNormalized(filter):
+  namespace = dict(NAMES)
+  namespace['__builtins__'] = {}
+  return eval(compile('lambda v: ({})'.format(filter), '<filter>', 'eval'), namespace)
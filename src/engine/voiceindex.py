@@ -0,0 +1,344 @@
+﻿####################################################################################################
+# Copyright 2013 John Crawford
+#
+# This file is part of PatchCorral.
+#
+# PatchCorral is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PatchCorral is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PatchCorral.  If not, see <http://www.gnu.org/licenses/>.
+####################################################################################################
+
+## @file
+#  Inverted indexes over a voicecatalog.VoiceCatalog.  For each indexed column, every value maps
+#  to a bitmap (a Python integer with bit "r" set for catalog row "r") of the rows holding it, so
+#  facet selections resolve by bitwise intersection instead of a scan.  Channels aren't catalog
+#  columns; they're resolved by narrowing the channels of the sequence's voicecatalog.ChannelProduct
+#  parts.
+
+from . import vectorfilter
+from . import voicecatalog
+from . import voicefilter
+from array import array
+import ast
+import collections
+
+
+
+##
+#  Returns a bitmap with the bits of the given rows set.
+#  @param rows Iterable of integer rows.  A "range" is converted without iterating it.
+#  @return Integer bitmap.
+def toBitmap(rows):
+  if isinstance(rows, range) and rows.step == 1:
+    return ((1 << len(rows)) - 1) << rows.start if len(rows) > 0 else 0
+  rows = list(rows)
+  if len(rows) == 0:
+    return 0
+  data = bytearray((max(rows) >> 3) + 1)
+  for row in rows:
+    data[row >> 3] |= 1 << (row & 7)
+  return int.from_bytes(data, 'little')
+
+##
+#  Returns the rows whose bits are set in the given bitmap.
+#  @param bitmap Integer bitmap.
+#  @return array of integer rows, ascending.
+def fromBitmap(bitmap):
+  ret = array('I')
+  for idx, byte in enumerate(bitmap.to_bytes((bitmap.bit_length() + 7) >> 3, 'little')):
+    if byte:
+      base = idx << 3
+      ret.extend(base + bit for bit in range(8) if byte & (1 << bit))
+  return ret
+
+##
+#  Joins the given conjuncts back into a filter string.
+#  @param nodes List of ast nodes.
+#  @return Filter string, or "None" if there are no conjuncts.
+def joinConjuncts(nodes):
+  if len(nodes) == 0:
+    return None
+  return ' and '.join('({})'.format(ast.unparse(node)) for node in nodes)
+
+##
+#  Returns the voicecatalog.ChannelProduct parts making up the given voice ID sequence.
+#  @param voiceIds Sequence of voice IDs.
+#  @return List of ChannelProduct objects, or "None" if the sequence isn't made of them.
+def getProducts(voiceIds):
+  if isinstance(voiceIds, voicecatalog.ChannelProduct):
+    return [voiceIds]
+  if isinstance(voiceIds, voicecatalog.IdChain):
+    ret = []
+    for part in voiceIds.parts:
+      products = getProducts(part)
+      if products is None:
+        return None
+      ret.extend(products)
+    return ret
+  return None
+
+##
+#  Narrows the given voicecatalog.ChannelProduct parts to the given rows and channels.
+#  @param catalog voicecatalog.VoiceCatalog object.
+#  @param products List of ChannelProduct objects.
+#  @param rowBitmap Integer bitmap of the rows to keep, or "None" to keep every row.
+#  @param channels Set of channels to keep, or "None" to keep every channel.
+#  @return voicecatalog.VoiceSequence object.
+def narrow(catalog, products, rowBitmap, channels):
+  parts = []
+  for product in products:
+    rows = product.rows
+    if rowBitmap is not None:
+      rows = fromBitmap(toBitmap(rows) & rowBitmap)
+    productChannels = product.channels
+    if channels is not None:
+      productChannels = [channel for channel in productChannels if channel in channels]
+    if len(rows) > 0 and len(productChannels) > 0:
+      parts.append(voicecatalog.ChannelProduct(rows, productChannels))
+  return catalog.voices(voicecatalog.IdChain(parts))
+
+##
+#  Returns the channels passing the given test.
+#  @param test Function taking a channel and returning a truthy value if it matches.
+#  @return Set of integers.
+def getMatchingChannels(test):
+  return set(channel for channel in range(1 << voicecatalog.CHANNEL_BITS) if test(channel))
+
+##
+#  Inverted indexes (value -> row bitmap) over the columns of a voicecatalog.VoiceCatalog.
+#  Rows added to the catalog are indexed incrementally the next time the index is used.
+class VoiceIndex():
+
+  ## Indexed catalog columns.  "bank" is the (msb, lsb) pair.
+  COLUMNS = ('device', 'category', 'msb', 'lsb', 'pc', 'bank')
+
+  ##
+  #  Class initializer.
+  #  @param catalog voicecatalog.VoiceCatalog object.
+  #  @return "None".
+  def __init__(self, catalog):
+    self.catalog = catalog
+    self.bitmaps = None
+    self.numRows = None
+    self.revision = None
+    self.update()
+
+  ##
+  #  Returns the bitmap of rows whose value in the given column passes the given test.
+  #  @param column Indexed column name.
+  #  @param test Function taking a decoded value and returning a truthy value if it matches.
+  #  @return Integer bitmap.
+  def getBitmap(self, column, test):
+    self.update()
+    ret = 0
+    for key, bitmap in self.bitmaps[column].items():
+      if test(self._decode(column, key)):
+        ret |= bitmap
+    return ret
+
+  ##
+  #  Counts the voices holding each value of every indexed column, plus each channel, in one
+  #  aggregation pass.  Cached on the sequence.
+  #  @param voices voicecatalog.VoiceSequence object.
+  #  @return Dictionary mapping each column in "COLUMNS" (and "channel") to a dictionary of
+  #    decoded value -> number of voices.
+  def getCounts(self, voices):
+    try:
+      return voices.cache['counts']
+    except KeyError:
+      pass
+    self.update()
+    counts = dict((column, collections.Counter()) for column in self.COLUMNS + ('channel',))
+    products = getProducts(voices.voiceIds)
+    if products is None:
+      #Count voices per row and channel, then fold the rows into each column.
+      rowCounts = collections.Counter()
+      mask = (1 << voicecatalog.CHANNEL_BITS) - 1
+      for vid in voices.voiceIds:
+        rowCounts[vid >> voicecatalog.CHANNEL_BITS] += 1
+        counts['channel'][vid & mask] += 1
+      columns = self.catalog.columns
+      for row, count in rowCounts.items():
+        for column in self.COLUMNS:
+          if column == 'bank':
+            key = (columns['msb'][row], columns['lsb'][row])
+          else:
+            key = columns[column][row]
+          counts[column][key] += count
+      for column in self.COLUMNS:
+        counts[column] = dict((self._decode(column, key), count) for key, count in counts[column].items())
+    else:
+      for product in products:
+        if len(product.rows) == 0 or len(product.channels) == 0:
+          continue
+        for channel in product.channels:
+          counts['channel'][channel] += len(product.rows)
+        rowBitmap = toBitmap(product.rows)
+        for column in self.COLUMNS:
+          for key, bitmap in self.bitmaps[column].items():
+            count = (bitmap & rowBitmap).bit_count()
+            if count:
+              counts[column][self._decode(column, key)] += count * len(product.channels)
+    ret = voices.cache['counts'] = dict((column, dict(count)) for column, count in counts.items())
+    return ret
+
+  ##
+  #  Returns the channels the given voices are on.
+  #  @param voices voicecatalog.VoiceSequence object.
+  #  @return Set of integers.
+  def getChannels(self, voices):
+    products = getProducts(voices.voiceIds)
+    if products is None:
+      mask = (1 << voicecatalog.CHANNEL_BITS) - 1
+      return set(vid & mask for vid in voices.voiceIds)
+    return set(channel for product in products if len(product.rows) > 0 for channel in product.channels)
+
+  ##
+  #  Returns the bitmap of catalog rows used by the given voices.  Cached on the sequence.
+  #  @param voices voicecatalog.VoiceSequence object.
+  #  @return Integer bitmap.
+  def getRowBitmap(self, voices):
+    try:
+      return voices.cache['rowBitmap']
+    except KeyError:
+      pass
+    products = getProducts(voices.voiceIds)
+    if products is None:
+      ret = toBitmap(vid >> voicecatalog.CHANNEL_BITS for vid in voices.voiceIds)
+    else:
+      ret = 0
+      for product in products:
+        if len(product.channels) > 0:
+          ret |= toBitmap(product.rows)
+    voices.cache['rowBitmap'] = ret
+    return ret
+
+  ##
+  #  Returns the distinct values of the given column among the given voices.
+  #  @param column Catalog column name.  Indexed columns are answered from the index; others are
+  #    decoded from the rows.
+  #  @param voices voicecatalog.VoiceSequence object.
+  #  @return Set of decoded values.
+  def getValues(self, column, voices):
+    self.update()
+    rowBitmap = self.getRowBitmap(voices)
+    if column in self.bitmaps:
+      return set(
+        self._decode(column, key) for key, bitmap in self.bitmaps[column].items() if bitmap & rowBitmap
+      )
+    return set(self.catalog.get(column, row) for row in fromBitmap(rowBitmap))
+
+  ##
+  #  Decodes an index key of the given column.
+  #  @param column Indexed column name.
+  #  @param key Index key.
+  #  @return Decoded value.
+  def _decode(self, column, key):
+    try:
+      return self.catalog.tables[column].values[key]
+    except KeyError:
+      return key
+
+  ##
+  #  Narrows the given voices using the facet comparisons in the given filter.  Top-level
+  #  conjuncts of the form "v.<attr> in [...]" or "v.<attr> == ..." (for "category", "msb", "lsb",
+  #  "_pc", "channel" and "device.<attr>") are resolved through the index; the rest are returned
+  #  as a residual filter.
+  #  @param voices voicecatalog.VoiceSequence object made of ChannelProduct parts with ascending
+  #    rows (such as a device's voices or SynthNav.fullVoiceList).
+  #  @param filter Filter string.
+  #  @return 2-tuple "(voices, residual)" where "voices" is a voicecatalog.VoiceSequence and
+  #    "residual" is a filter string (or "None" if nothing is left to evaluate), or "None" if the
+  #    index couldn't be used.
+  def select(self, voices, filter):
+    products = getProducts(voices.voiceIds)
+    if products is None:
+      return None
+    self.update()
+    rowBitmap = None
+    channels = None
+    residual = []
+    conjuncts = voicefilter.getConjuncts(filter)
+    for node in conjuncts:
+      if isinstance(node, ast.Constant) and node.value is True:
+        continue
+      try:
+        column, test = self._getFacet(node)
+      except vectorfilter.Unsupported:
+        residual.append(node)
+        continue
+      if column is None:
+        matching = getMatchingChannels(test)
+        channels = matching if channels is None else channels & matching
+      else:
+        bitmap = self.getBitmap(column, test)
+        rowBitmap = bitmap if rowBitmap is None else rowBitmap & bitmap
+    if len(residual) == len(conjuncts):
+      return None
+    return narrow(self.catalog, products, rowBitmap, channels), joinConjuncts(residual)
+
+  ##
+  #  Resolves the given conjunct to a facet test.
+  #  @param node ast node.
+  #  @return 2-tuple "(column, test)" where "column" is an indexed column (or "None" for the
+  #    channel) and "test" takes a decoded value and returns whether it matches.
+  #  @throws vectorfilter.Unsupported If the conjunct isn't a facet comparison.
+  def _getFacet(self, node):
+    if not isinstance(node, ast.Compare) or len(node.ops) != 1:
+      raise vectorfilter.Unsupported()
+    column, decode = vectorfilter.getAttribute(node.left)
+    if column is not None and column not in self.bitmaps:
+      raise vectorfilter.Unsupported()
+    literal = vectorfilter.getLiteral(node.comparators[0])
+    op = node.ops[0]
+    if isinstance(op, ast.In):
+      test = lambda value: value in literal
+    elif isinstance(op, ast.Eq):
+      test = lambda value: value == literal
+    else:
+      raise vectorfilter.Unsupported()
+    if decode is not None:
+      return column, lambda value: test(decode(value))
+    return column, test
+
+  ##
+  #  Brings the index up to date with the catalog.  New rows are added incrementally; if existing
+  #  rows were modified, the index is rebuilt.  Holds the catalog's lock while changing the index,
+  #  since a filter thread may be reading it.
+  #  @return "None".
+  def update(self):
+    if self.revision == self.catalog.revision and self.numRows == len(self.catalog):
+      return
+    with self.catalog.lock:
+      if self.revision != self.catalog.revision:
+        self.bitmaps = dict((column, {}) for column in self.COLUMNS)
+        self.numRows = 0
+        self.revision = self.catalog.revision
+      numRows = len(self.catalog)
+      if numRows == self.numRows:
+        return
+      columns = self.catalog.columns
+      for column in self.COLUMNS:
+        groups = {}
+        if column == 'bank':
+          keys = zip(columns['msb'][self.numRows:], columns['lsb'][self.numRows:])
+        else:
+          keys = columns[column][self.numRows:]
+        for row, key in enumerate(keys, self.numRows):
+          try:
+            groups[key].append(row)
+          except KeyError:
+            groups[key] = [row]
+        bitmaps = self.bitmaps[column]
+        for key, rows in groups.items():
+          bitmaps[key] = bitmaps.get(key, 0) | toBitmap(rows)
+      self.numRows = numRows
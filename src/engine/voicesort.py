@@ -0,0 +1,178 @@
+####################################################################################################
+# Copyright 2013 John Crawford
+#
+# This file is part of PatchCorral.
+#
+# PatchCorral is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PatchCorral is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PatchCorral.  If not, see <http://www.gnu.org/licenses/>.
+####################################################################################################
+
+## @file
+#  Precomputed sort orders over a voicecatalog.VoiceCatalog.  For each sortable voice tag, the
+#  catalog rows are kept sorted once (as a permutation) along with each row's rank in it, so a list
+#  of voices is ordered by comparing plain integers instead of calling key functions on voices.
+
+from . import voicecatalog
+from array import array
+import heapq
+import operator
+import re
+
+
+
+##
+#  Returns a key that orders values naturally ("USER 2" before "USER 10"), with "None" last.
+#  @param value Column value.
+#  @return Tuple.
+def naturalKey(value):
+  if value is None:
+    return (1, ())
+  if isinstance(value, int):
+    return (0, ('', value))
+  parts = re.split(r'(\d+)', str(value).lower())
+  return (0, tuple(int(part) if idx % 2 else part for idx, part in enumerate(parts)))
+
+##
+#  Sort orders of catalog rows, one per sortable voice tag.  Orders are built the first time they
+#  are used and extended by merging as rows are added to the catalog.
+class SortIndex():
+
+  ## Columns compared, in order, for each sortable tag.  "device.<attr>" compares an attribute of
+  #  the row's device.  Ties are broken by catalog row.
+  KEYS = {
+    'name': ('name', 'msb', 'lsb', 'pc'),
+    'msb': ('msb', 'lsb', 'pc'),
+    'lsb': ('lsb', 'msb', 'pc'),
+    '_pc': ('pc', 'msb', 'lsb'),
+    'bank': ('msb', 'lsb', 'pc'),
+    'device.portNum': ('device.portNum', 'msb', 'lsb', 'pc'),
+    'device.portName': ('device.portName', 'msb', 'lsb', 'pc'),
+    'channel': ('device.portName', 'msb', 'lsb', 'pc'),
+    'category': ('category', 'name'),
+    'voiceNum': ('voiceNum',),
+  }
+
+  ## Tags sorted by channel first (then by their "KEYS").
+  CHANNEL_MAJOR = ('channel',)
+
+  ## Bits of a sort key that hold the rank when the channel comes first.
+  RANK_BITS = 32
+
+  ##
+  #  Class initializer.
+  #  @param catalog voicecatalog.VoiceCatalog object.
+  #  @return "None".
+  def __init__(self, catalog):
+    self.catalog = catalog
+    self.orders = {}  #Tag -> (perm, ranks, numRows, revision).
+
+  ##
+  #  Returns a function mapping a row to its comparison key for the given tag.  Values of interned
+  #  columns are compared through the rank of their code among the table's sorted values, so each
+  #  distinct value is only converted once.
+  #  @param tag Sortable tag (see "SortIndex.KEYS").
+  #  @return Function taking an integer row.
+  def _getRowKey(self, tag):
+    getters = []
+    for key in self.KEYS[tag]:
+      column, _, attr = key.partition('.')
+      codes = self.catalog.columns[column]
+      try:
+        values = self.catalog.tables[column].values
+      except KeyError:
+        getters.append(codes.__getitem__)
+        continue
+      if attr:
+        values = list(map(operator.attrgetter(attr), values))
+      valueKeys = list(map(naturalKey, values))
+      codeRanks = [0] * len(values)
+      for rank, code in enumerate(sorted(range(len(values)), key=valueKeys.__getitem__)):
+        codeRanks[code] = rank
+      getters.append(lambda row, codes=codes, codeRanks=codeRanks: codeRanks[codes[row]])
+    return lambda row: tuple(getter(row) for getter in getters) + (row,)
+
+  ##
+  #  Returns the sort order of the catalog rows for the given tag, bringing it up to date first.
+  #  @param tag Sortable tag (see "SortIndex.KEYS").
+  #  @return 2-tuple "(perm, ranks)" where "perm" lists the rows in order and "ranks[row]" is the
+  #    position of "row" in "perm".
+  def getOrder(self, tag):
+    numRows = len(self.catalog)
+    try:
+      perm, ranks, orderRows, revision = self.orders[tag]
+    except KeyError:
+      perm, ranks, orderRows, revision = array('I'), array('I'), 0, None
+    if revision != self.catalog.revision:
+      perm, orderRows = array('I'), 0
+    if orderRows != numRows:
+      rowKey = self._getRowKey(tag)
+      added = sorted(range(orderRows, numRows), key=rowKey)
+      if len(perm) > 0:
+        perm = array('I', heapq.merge(perm, added, key=rowKey))
+      else:
+        perm = array('I', added)
+      ranks = array('I', (0,)) * numRows
+      for rank, row in enumerate(perm):
+        ranks[row] = rank
+      self.orders[tag] = (perm, ranks, numRows, self.catalog.revision)
+    return perm, ranks
+
+  ##
+  #  Returns the sort keys of the given voices for the given tag.  Keys are distinct integers, so
+  #  sorting them with no key function orders the voices.
+  #  @param tag Sortable tag (see "SortIndex.KEYS").
+  #  @param voiceIds Iterable of integer voice IDs.
+  #  @return List of integers.
+  def getSortKeys(self, tag, voiceIds):
+    ranks = self.getOrder(tag)[1]
+    bits = voicecatalog.CHANNEL_BITS
+    mask = (1 << bits) - 1
+    if tag in self.CHANNEL_MAJOR:
+      rankBits = self.RANK_BITS
+      return [((vid & mask) << rankBits) | ranks[vid >> bits] for vid in voiceIds]
+    return [(ranks[vid >> bits] << bits) | (vid & mask) for vid in voiceIds]
+
+  ##
+  #  Returns the voice ID a sort key was made from.  Keys go stale once rows are added to the
+  #  catalog (see "SortIndex.isCurrent").
+  #  @param tag Sortable tag (see "SortIndex.KEYS").
+  #  @param key Integer returned by "getSortKeys".
+  #  @return Integer voice ID.
+  def getVoiceId(self, tag, key):
+    perm = self.orders[tag][0]
+    if tag in self.CHANNEL_MAJOR:
+      channel, rank = key >> self.RANK_BITS, key & ((1 << self.RANK_BITS) - 1)
+    else:
+      rank, channel = voicecatalog.splitVoiceId(key)
+    return voicecatalog.voiceId(perm[rank], channel)
+
+  ##
+  #  Checks whether sort keys made for the given tag are still valid.
+  #  @param tag Sortable tag (see "SortIndex.KEYS").
+  #  @return "True" if the catalog hasn't changed since the tag's order was last brought up to date.
+  def isCurrent(self, tag):
+    try:
+      numRows, revision = self.orders[tag][2:]
+    except KeyError:
+      return False
+    return numRows == len(self.catalog) and revision == self.catalog.revision
+
+  ##
+  #  Returns the given voices sorted by the given tag.
+  #  @param voiceIds Iterable of integer voice IDs.
+  #  @param tag Sortable tag (see "SortIndex.KEYS").
+  #  @param reverse If "True", sorts in descending order.
+  #  @return array of voice IDs.
+  def sort(self, voiceIds, tag, reverse=False):
+    keys = sorted(self.getSortKeys(tag, voiceIds), reverse=reverse)
+    return array('I', (self.getVoiceId(tag, key) for key in keys))
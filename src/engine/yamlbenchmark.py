@@ -0,0 +1,112 @@
+####################################################################################################
+# Copyright 2013 John Crawford
+#
+# This file is part of PatchCorral.
+#
+# PatchCorral is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PatchCorral is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PatchCorral.  If not, see <http://www.gnu.org/licenses/>.
+####################################################################################################
+
+## @file
+#  Times loading and saving a userdata file with the pure-Python PyYAML loader and dumper (and the
+#  full Python-object tag resolver) against yamlfile.File's libyaml-backed safe path.
+#
+#  Usage: python -m patchcorral.src.engine.yamlbenchmark <userdata file> [repeats]
+
+from patchcorral.src.engine import mididevice
+from patchcorral.src.engine import yamlfile
+import os
+import sys
+import tempfile
+import time
+import yaml
+
+
+
+##
+#  Returns the best of several timings of the given function.
+#  @param func Function taking no arguments.
+#  @param repeats Number of times to run it.
+#  @return 2-tuple "(seconds, last return value)".
+def bestOf(func, repeats):
+  best = None
+  for _ in range(repeats):
+    start = time.perf_counter()
+    ret = func()
+    elapsed = time.perf_counter() - start
+    if best is None or elapsed < best:
+      best = elapsed
+  return best, ret
+
+##
+#  Loads the file with the pure-Python loader.
+#  @param filename Path to the file.
+#  @return Root of the document.
+def loadPython(filename):
+  with mididevice.bindDevices():
+    with open(filename, 'r') as fd:
+      return yaml.load(fd, Loader=yaml.Loader)
+
+##
+#  Saves the given document with the pure-Python dumper.
+#  @param root Root of the document.
+#  @param filename Path to the file.
+#  @return "None".
+def savePython(root, filename):
+  with open(filename, 'w') as fd:
+    fd.write(yaml.dump(root, Dumper=yaml.Dumper))
+
+##
+#  Loads the file with yamlfile.File.
+#  @param filename Path to the file.
+#  @return Root of the document.
+def loadFast(filename):
+  with mididevice.bindDevices():
+    return yamlfile.File(filename).getRoot()
+
+##
+#  Saves the given document with yamlfile.File.
+#  @param root Root of the document.
+#  @param filename Path to the file.
+#  @return "None".
+def saveFast(root, filename):
+  yamlfile.File(None, root).save(filename)
+
+##
+#  Runs the benchmark.
+#  @param filename Path to the userdata file.
+#  @param repeats Number of runs of each operation; the fastest is reported.
+#  @return "None".
+def main(filename, repeats=3):
+  print('{}: {} bytes, libyaml {}'.format(
+    filename,
+    os.path.getsize(filename),
+    'available' if yaml.__with_libyaml__ else 'unavailable',
+  ))
+  fd, tmpFilename = tempfile.mkstemp(suffix='.yml')
+  os.close(fd)
+  try:
+    for label, load, save in (
+      ('pure Python', loadPython, savePython),
+      ('yamlfile', loadFast, saveFast),
+    ):
+      loadTime, root = bestOf(lambda: load(filename), repeats)
+      saveTime, _ = bestOf(lambda: save(root, tmpFilename), repeats)
+      print('{:12} load {:8.3f} s  save {:8.3f} s'.format(label, loadTime, saveTime))
+  finally:
+    os.remove(tmpFilename)
+
+if __name__ == '__main__':
+  if len(sys.argv) not in (2, 3):
+    sys.exit('Usage: python -m patchcorral.src.engine.yamlbenchmark <userdata file> [repeats]')
+  main(sys.argv[1], *(int(arg) for arg in sys.argv[2:]))
@@ -18,12 +18,44 @@
 ####################################################################################################
 
 ## @file
-#  Represents a YAML file, simplying procedures such as loading and saving.
+#  Represents a YAML file, simplying procedures such as loading and saving.  Files are parsed and
+#  written with libyaml when it's available, using the safe loader and dumper: only plain YAML
+#  and the PatchCorral types registered with "Loader" and "Dumper" are supported.
 
 from . import file
 import yaml
 
+try:
+  from yaml import CSafeLoader as _BaseLoader, CSafeDumper as _BaseDumper
+except ImportError:
+  from yaml import SafeLoader as _BaseLoader, SafeDumper as _BaseDumper
+
+
 
+##
+#  Loader used by "File".  PatchCorral types register their constructors here (see
+#  "yaml.Loader.add_constructor"), so files can't construct arbitrary Python objects.
+class Loader(_BaseLoader):
+  pass
+
+##
+#  Dumper used by "File".  PatchCorral types register their representers here (see
+#  "yaml.Dumper.add_representer").
+class Dumper(_BaseDumper):
+  pass
+
+##
+#  A pre-serialized "name: value" entry of a mapping in the root of a File.  Keeping the Section of
+#  an unchanged value lets the document be saved again without serializing that value.
+class Section():
+
+  ##
+  #  Class initializer.  Serializes the entry.
+  #  @param name Key of the entry.
+  #  @param value Value of the entry.
+  #  @return "None".
+  def __init__(self, name, value):
+    self.text = yaml.dump({name: value}, Dumper=Dumper)
 
 ##
 #  Represents a YAML file, simplying procedures such as loading and saving.
@@ -40,7 +72,7 @@ class File(file.File):
 
   def _load(self, filename):
     with open(filename, 'r') as fd:
-      self.root = yaml.load(fd)
+      self.root = yaml.load(fd, Loader=Loader)
 
   ##
   #  Returns the object considered to be the root of the document.
@@ -54,6 +86,26 @@ class File(file.File):
   def setRoot(self, root):
     self.root = root
 
+  ##
+  #  Writes the root to the given file.  A root mapping entry whose value is a dictionary of
+  #  Section objects is written last, by copying the sections' text.  Its key must be a plain
+  #  string.
+  #  @param filename Path to write to.
+  #  @return "None".
   def _save(self, filename):
+    root = self.root
+    sectioned = {}
+    if isinstance(root, dict):
+      root = {}
+      for key, value in self.root.items():
+        if isinstance(value, dict) and value and all(isinstance(v, Section) for v in value.values()):
+          sectioned[key] = value
+        else:
+          root[key] = value
     with open(filename, 'w') as fd:
-      fd.write(yaml.dump(self.root))
+      if root or not sectioned:
+        yaml.dump(root, fd, Dumper=Dumper)
+      for key, sections in sorted(sectioned.items()):
+        fd.write('{}:\n'.format(key))
+        for name, section in sorted(sections.items()):
+          fd.write(''.join('  ' + line for line in section.text.splitlines(True)))
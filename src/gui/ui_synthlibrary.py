@@ -66,6 +66,14 @@ class MainWidget(QtGui.QWidget):
     
   def addVoiceToCurrList(self, voice):
     self.getCurrVoiceList().add(voice)
+
+  ##
+  #  Writes any pending user data changes before the window closes.
+  #  @param event QCloseEvent object.
+  #  @return "None".
+  def closeEvent(self, event):
+    self.synthNav.flushUserData()
+    super().closeEvent(event)
     
   def getCurrVoiceList(self):
     return self.widget_queued_list.voiceList
@@ -82,15 +90,15 @@ class FilterWidget(QtGui.QWidget):
     # Synth Select
     self.lw_synth = QtGui.QListWidget(self)
     self.lw_synth.setSelectionMode(QtGui.QAbstractItemView.ExtendedSelection)
-    self.lw_synth.addItems([x.get_port_name() for x in self.synthNav.getMIDIOutDevs()])
+    self.addFacetItems(self.lw_synth, [x.get_port_name() for x in self.synthNav.getMIDIOutDevs()])
     # Channel Select
     self.lw_channel = QtGui.QListWidget(self)
     self.lw_channel.setSelectionMode(QtGui.QAbstractItemView.ExtendedSelection)
-    self.lw_channel.addItems(list(str(x) for x in self.synthNav.getCurrChannels()))
+    self.addFacetItems(self.lw_channel, sorted(self.synthNav.getCurrChannels()))
     # Category Select
     self.lw_category = QtGui.QListWidget(self)
     self.lw_category.setSelectionMode(QtGui.QAbstractItemView.ExtendedSelection)
-    self.lw_category.addItems(list(self.synthNav.getCurrCategories()))
+    self.addFacetItems(self.lw_category, sorted(self.synthNav.getCurrCategories()))
     # Custom Filter
     self.widget_filter_custom = CustomFilterWidget(self, self.synthNav)
     #Lay it out.
@@ -106,6 +114,20 @@ class FilterWidget(QtGui.QWidget):
     self.lw_channel.itemSelectionChanged.connect(self.onChannelSelectionChanged)
     self.lw_category.itemSelectionChanged.connect(self.onCategorySelectionChanged)
     self.widget_filter_custom.pb_clearFilter.clicked.connect(self.onFilterClear)
+    self.synthNav.filterChanged.connect(self.refreshCounts)
+    self.synthNav.searchChanged.connect(self.refreshCounts)
+    self.refreshCounts()
+
+  ##
+  #  Adds an item for each of the given facet values.  The value itself is kept in the item's
+  #  "UserRole" data so the displayed text can include a count.
+  #  @param listWidget QListWidget object.
+  #  @param values Iterable of facet values.
+  #  @return "None".
+  def addFacetItems(self, listWidget, values):
+    for value in values:
+      item = QtGui.QListWidgetItem(str(value), listWidget)
+      item.setData(QtCore.Qt.UserRole, str(value))
 
   def onFilterClear(self):
     for item in self.lw_synth.selectedItems():
@@ -122,7 +144,7 @@ class FilterWidget(QtGui.QWidget):
       nfilter = None
     else:
       nfilter = 'and v.device.portName in [\'{}\']'.format('\', \''.join(
-        item.text() for item in self.lw_synth.selectedItems()
+        item.data(QtCore.Qt.UserRole) for item in self.lw_synth.selectedItems()
       ))
     self.widget_filter_custom.updateFilter(nfilter, ofilter)
     self.synthFilter = nfilter
@@ -134,7 +156,7 @@ class FilterWidget(QtGui.QWidget):
       nfilter = None
     else:
       nfilter = 'and v.channel in [{}]'.format(', '.join(
-        item.text() for item in self.lw_channel.selectedItems()
+        item.data(QtCore.Qt.UserRole) for item in self.lw_channel.selectedItems()
       ))
     self.widget_filter_custom.updateFilter(nfilter, ofilter)
     self.channelFilter = nfilter
@@ -146,11 +168,28 @@ class FilterWidget(QtGui.QWidget):
       nfilter = None
     else:
       nfilter = 'and v.category in [\'{}\']'.format('\', \''.join(
-        item.text() for item in self.lw_category.selectedItems()
+        item.data(QtCore.Qt.UserRole) for item in self.lw_category.selectedItems()
       ))
     self.widget_filter_custom.updateFilter(nfilter, ofilter)
     self.categoryFilter = nfilter
 
+  ##
+  #  Updates the facet items to show how many of the filtered voices have each value, e.g.
+  #  "STRINGS (412)".
+  #  @return "None".
+  def refreshCounts(self):
+    counts = self.synthNav.getFacetCounts()
+    for listWidget, facet in (
+      (self.lw_synth, 'portName'),
+      (self.lw_channel, 'channel'),
+      (self.lw_category, 'category'),
+    ):
+      facetCounts = dict((str(value), count) for value, count in counts[facet].items())
+      for row in range(listWidget.count()):
+        item = listWidget.item(row)
+        value = item.data(QtCore.Qt.UserRole)
+        item.setText('{} ({})'.format(value, facetCounts.get(value, 0)))
+
 class CustomFilterWidget(QtGui.QWidget):
 
   def __init__(self, parent, synthNav):
@@ -160,6 +199,8 @@ class CustomFilterWidget(QtGui.QWidget):
     self.le_filter = QtGui.QLineEdit('True', self)
     self.pb_applyFilter = QtGui.QPushButton('Apply', self)
     self.pb_clearFilter = QtGui.QPushButton('Clear', self)
+    self.le_search = QtGui.QLineEdit(self)
+    self.le_search.setPlaceholderText('Search names (e.g. "sawbas")')
     #Lay it out.
     vbox = QtGui.QVBoxLayout(self)
     vbox.addWidget(QtGui.QLabel(
@@ -171,17 +212,21 @@ class CustomFilterWidget(QtGui.QWidget):
     hbox.addWidget(self.pb_clearFilter)
     hbox.addWidget(self.pb_applyFilter)
     vbox.addLayout(hbox)
+    vbox.addWidget(self.le_search)
     #Connect signals.
-    self.synthNav.filterChanged.connect(self.le_filter.setText)
+    self.synthNav.filterChanged.connect(self.onFilterChanged)
+    self.synthNav.filterFailed.connect(self.onFilterFailed)
+    self.le_filter.textEdited.connect(self.onFilterTextEdited)
     self.pb_applyFilter.clicked.connect(self.onApplyButtonPressed)
     self.pb_clearFilter.clicked.connect(self.onClearButtonPressed)
+    self.le_search.textChanged.connect(self.onSearchTextChanged)
 
   ##
   #  Callback for when the "Apply" button is pressed.
   #  @post Current filter will be applied to the engine.
   #  @return "None".
   def onApplyButtonPressed(self):
-    self.synthNav.filter(self.le_filter.text())
+    self.synthNav.filterAsync(self.le_filter.text())
 
   ##
   #  Callback for when the "Clear" button is pressed.
@@ -189,7 +234,43 @@ class CustomFilterWidget(QtGui.QWidget):
   #    the engine.
   #  @return "None".
   def onClearButtonPressed(self):
-    self.synthNav.filter('True')
+    self.le_filter.setText('True')
+    self.synthNav.filterAsync('True')
+
+  ##
+  #  Callback for when the engine's filter changes.
+  #  @param filter New filter string.
+  #  @post Any name search will be re-run over the newly-filtered voices.
+  #  @return "None".
+  def onFilterChanged(self, filter):
+    if self.le_filter.text() != filter:
+      self.le_filter.setText(filter)
+    self.le_filter.setToolTip('')
+    if self.le_search.text():
+      self.synthNav.search(self.le_search.text())
+
+  ##
+  #  Callback for when the engine couldn't apply a filter.
+  #  @param filter Filter string.
+  #  @param message Error message.
+  #  @return "None".
+  def onFilterFailed(self, filter, message):
+    if self.le_filter.text() == filter:
+      self.le_filter.setToolTip(message)
+
+  ##
+  #  Callback for each edit of the filter text.  Filters as the user types,
+  #  waiting for a pause in typing first.
+  #  @return "None".
+  def onFilterTextEdited(self, text):
+    self.synthNav.filterAsync(text, self.synthNav.FILTER_DELAY)
+
+  ##
+  #  Callback for each edit of the name search text.
+  #  @post The filtered list will show the best name matches first.
+  #  @return "None".
+  def onSearchTextChanged(self, text):
+    self.synthNav.search(text)
 
   ##
   #  Updates the custom filter.
@@ -197,16 +278,19 @@ class CustomFilterWidget(QtGui.QWidget):
   #  @param o Original filter string to replace.  If "None", "n" will be
   #    appended to the current filter string.
   #  @return "None".
-  #  @post The new filter will be applied to the engine.
+  #  @post The new filter will be shown and applied to the engine in the background.
   def updateFilter(self, n, o=None):
     currFilter = self.le_filter.text()
     if o is None:
-      if n is not None:
-        self.synthNav.filter('{} {}'.format(currFilter, n).strip())
+      if n is None:
+        return
+      newFilter = '{} {}'.format(currFilter, n).strip()
     else:
       if n is None:
         n = ''
-      self.synthNav.filter(currFilter.replace(o, n).strip())
+      newFilter = currFilter.replace(o, n).strip()
+    self.le_filter.setText(newFilter)
+    self.synthNav.filterAsync(newFilter)
 
 
 
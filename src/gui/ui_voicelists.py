@@ -22,10 +22,189 @@
 
 from PySide import QtGui, QtCore
 from patchcorral.src.engine import mididevice
-import traceback
+import bisect
 
 
 
+##
+#  Table model over a MIDIVoiceList.  Cells are read from the list as the view asks for them, so
+#  nothing is stored per row and any number of voices can be scrolled through (display strings
+#  come from the bounded cache of mididevice.MIDIVoice.getDisplayRow).  There is one column per
+#  entry of mididevice.MIDIVoice.tags.
+#
+#  The views are told about each change of the list in two steps, as Qt requires: the rows are
+#  announced from the list's "listAboutToChange" signal, before the list changes, and the
+#  announcement is completed from "listChanged".
+#
+#  When sorted, the model keeps the sorted sort keys (see voicesort.SortIndex) of the list's
+#  voices and updates them by bisection as voices are inserted or removed.
+class VoiceTableModel(QtCore.QAbstractTableModel):
+
+  ##
+  #  Class initializer.
+  #  @param parent QObject parent.
+  #  @param sortIndex voicesort.SortIndex object used for sorting.
+  #  @return "None".
+  def __init__(self, parent, sortIndex):
+    super().__init__(parent)
+    self.cols = mididevice.MIDIVoice.tags
+    self.sortIndex = sortIndex
+    self.voiceList = None
+    self.pendingChange = None  #How the change announced by "onListAboutToChange" is completed.
+    self.sortTag = None  #Tag the rows are sorted by, or "None" to show them in list order.
+    self.sortReverse = False
+    self.sortKeys = None  #Ascending sort keys of the list's voices while sorted.
+
+  def columnCount(self, parent=QtCore.QModelIndex()):
+    if parent.isValid():
+      return 0
+    return len(self.cols)
+
+  def data(self, index, role=QtCore.Qt.DisplayRole):
+    if role != QtCore.Qt.DisplayRole or not index.isValid():
+      return None
+    return self.getVoice(index.row()).getDisplayRow()[index.column()]
+
+  def flags(self, index):
+    return QtCore.Qt.ItemIsEnabled | QtCore.Qt.ItemIsSelectable
+
+  ##
+  #  Returns the voice shown in the given row.
+  #  @param row Integer row.
+  #  @return mididevice.MIDIVoice object.
+  def getVoice(self, row):
+    if self.sortKeys is None:
+      return self.voiceList[row]
+    key = self.sortKeys[self._toSortPos(row)]
+    return mididevice.CATALOG.voice(self.sortIndex.getVoiceId(self.sortTag, key))
+
+  def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+    if role != QtCore.Qt.DisplayRole:
+      return None
+    if orientation == QtCore.Qt.Horizontal:
+      return self.cols[section]
+    return str(section + 1)
+
+  ##
+  #  Announces a change the voice list is about to make to the views, naming the affected rows
+  #  only.  Completed by "onListChanged".
+  #  @param change synthnav.ListChange object.
+  #  @return "None".
+  def onListAboutToChange(self, change):
+    root = QtCore.QModelIndex()
+    last = change.start + change.count - 1
+    if self.sortKeys is not None and change.kind != 'reset' and self.sortIndex.isCurrent(self.sortTag):
+      #The shown order doesn't depend on list order; inserted and removed voices are placed by
+      #their keys once the change is made.
+      self.pendingChange = 'sorted' if change.kind in ('insert', 'remove') else None
+    elif self.sortKeys is not None:
+      self.pendingChange = 'reset'
+      self.beginResetModel()
+    elif change.kind == 'insert':
+      self.pendingChange = 'insert'
+      self.beginInsertRows(root, change.start, last)
+    elif change.kind == 'remove':
+      self.pendingChange = 'remove'
+      self.beginRemoveRows(root, change.start, last)
+    elif change.kind == 'move':
+      #Qt wants the destination as a row of the list before the move.
+      dest = change.dest + change.count if change.dest > change.start else change.dest
+      self.pendingChange = 'move'
+      self.beginMoveRows(root, change.start, last, root, dest)
+    else:
+      self.pendingChange = 'reset'
+      self.beginResetModel()
+
+  ##
+  #  Completes the announcement of a change made to the voice list (see "onListAboutToChange").
+  #  While sorted, each inserted or removed voice is placed by its key.
+  #  @param change synthnav.ListChange object.
+  #  @return "None".
+  def onListChanged(self, change):
+    pendingChange, self.pendingChange = self.pendingChange, None
+    root = QtCore.QModelIndex()
+    if pendingChange == 'sorted':
+      for key in self.sortIndex.getSortKeys(self.sortTag, change.voiceIds):
+        pos = bisect.bisect_left(self.sortKeys, key)
+        if change.kind == 'insert':
+          row = self._toRow(pos, len(self.sortKeys) + 1)
+          self.beginInsertRows(root, row, row)
+          self.sortKeys.insert(pos, key)
+          self.endInsertRows()
+        else:
+          row = self._toRow(pos, len(self.sortKeys))
+          self.beginRemoveRows(root, row, row)
+          del self.sortKeys[pos]
+          self.endRemoveRows()
+    elif pendingChange == 'insert':
+      self.endInsertRows()
+    elif pendingChange == 'remove':
+      self.endRemoveRows()
+    elif pendingChange == 'move':
+      self.endMoveRows()
+    elif pendingChange == 'reset':
+      self._sort()
+      self.endResetModel()
+
+  def rowCount(self, parent=QtCore.QModelIndex()):
+    if parent.isValid() or self.voiceList is None:
+      return 0
+    if self.sortKeys is not None:
+      return len(self.sortKeys)
+    return len(self.voiceList)
+
+  ##
+  #  Orders the rows by the given column.
+  #  @param column Column index.  If negative, rows are shown in list order.
+  #  @param order QtCore.Qt.AscendingOrder or QtCore.Qt.DescendingOrder.
+  #  @return "None".
+  def sort(self, column, order=QtCore.Qt.AscendingOrder):
+    self.layoutAboutToBeChanged.emit()
+    self.sortTag = self.cols[column] if column >= 0 else None
+    self.sortReverse = order == QtCore.Qt.DescendingOrder
+    self._sort()
+    self.layoutChanged.emit()
+
+  ##
+  #  Recomputes "sortKeys" from the whole list.
+  #  @return "None".
+  def _sort(self):
+    if self.sortTag is None or self.voiceList is None:
+      self.sortKeys = None
+    else:
+      self.sortKeys = self.sortIndex.getSortKeys(self.sortTag, self.voiceList.getVoiceIds())
+      self.sortKeys.sort()
+
+  ##
+  #  Converts between a position in "sortKeys" and a row.
+  #  @param pos Integer position.
+  #  @param numRows Number of rows.
+  #  @return Integer row.
+  def _toRow(self, pos, numRows):
+    return numRows - 1 - pos if self.sortReverse else pos
+
+  ##
+  #  Converts a row to a position in "sortKeys".
+  #  @param row Integer row.
+  #  @return Integer position.
+  def _toSortPos(self, row):
+    return self._toRow(row, len(self.sortKeys))
+
+  ##
+  #  Shows the given voice list.
+  #  @param voiceList MIDIVoiceList object.
+  #  @return "None".
+  def setVoiceList(self, voiceList):
+    self.beginResetModel()
+    if self.voiceList is not None:
+      self.voiceList.listAboutToChange.disconnect(self.onListAboutToChange)
+      self.voiceList.listChanged.disconnect(self.onListChanged)
+    self.voiceList = voiceList
+    self.voiceList.listAboutToChange.connect(self.onListAboutToChange)
+    self.voiceList.listChanged.connect(self.onListChanged)
+    self._sort()
+    self.endResetModel()
+
 ##
 #  Base class for voice list widgets.
 class VoiceListWidget(QtGui.QWidget):
@@ -33,7 +212,7 @@ class VoiceListWidget(QtGui.QWidget):
   ## Currently-assigned patchcorral.src.engine.mididevice.MIDIVoiceList object.
   voiceList = None
 
-  class TableWidget(QtGui.QTableWidget):
+  class TableView(QtGui.QTableView):
 
     keyPressed = QtCore.Signal(QtGui.QKeyEvent)
 
@@ -45,68 +224,58 @@ class VoiceListWidget(QtGui.QWidget):
     super().__init__(parent)
     self.synthNav = synthNav
     assert self.voiceList is not None, '"self.voiceList" needs to be populated by the subclass.'
-    self.voiceMap = {}
-    if len(self.voiceList) == 0:
-      self.cols = mididevice.MIDIVoice.tags
-    else:
-      self.cols = list(self.voiceList[0].keys())
-    self.numCols = len(self.cols)
     #Create widgets.
-    self.tw_currVoices = self.TableWidget(0, self.numCols, self)
-    self.tw_currVoices.setHorizontalHeaderLabels(self.cols)
+    self.model = VoiceTableModel(self, synthNav.sortIndex)
+    self.cols = self.model.cols
+    self.numCols = len(self.cols)
+    self.tv_currVoices = self.TableView(self)
+    self.tv_currVoices.setModel(self.model)
+    self.tv_currVoices.setSelectionBehavior(QtGui.QAbstractItemView.SelectRows)
+    self.tv_currVoices.horizontalHeader().setClickable(True)
     #Lay it out.
     self.vbox = QtGui.QVBoxLayout(self)
-    self.vbox.addWidget(self.tw_currVoices)
+    self.vbox.addWidget(self.tv_currVoices)
     #Populate voices.
     self.setVoiceList(self.voiceList)
     #Connect signals.
-    self.tw_currVoices.keyPressed.connect(self.onKeypressEvent)
+    self.tv_currVoices.keyPressed.connect(self.onKeypressEvent)
+    self.tv_currVoices.horizontalHeader().sectionClicked.connect(self.onHeaderClicked)
+
+  ##
+  #  Returns the voices in the selected rows, in row order.
+  #  @return List of mididevice.MIDIVoice objects.
+  def getSelectedVoices(self):
+    rows = sorted(set(index.row() for index in self.tv_currVoices.selectionModel().selectedIndexes()))
+    return [self.model.getVoice(row) for row in rows]
+
+  ##
+  #  Callback for when a column header is clicked.  Cycles the column between
+  #  ascending, descending and list order.
+  #  @param col Column index.
+  #  @return "None".
+  def onHeaderClicked(self, col):
+    header = self.tv_currVoices.horizontalHeader()
+    if self.model.sortTag != self.cols[col]:
+      order = QtCore.Qt.AscendingOrder
+    elif not self.model.sortReverse:
+      order = QtCore.Qt.DescendingOrder
+    else:
+      col = -1
+    header.setSortIndicatorShown(col >= 0)
+    if col >= 0:
+      header.setSortIndicator(col, order)
+      self.model.sort(col, order)
+    else:
+      self.model.sort(-1)
 
   def onKeypressEvent(self, event):
     pass
 
-  def refreshCurrVoices(self):
-    print("refreshCurrVoices called")
-    rowCountI = self.tw_currVoices.rowCount()
-    rowCountF = min(len(self.voiceList), 1000)
-    self.tw_currVoices.clearContents()
-    print("refreshCurrVoices setting row count")
-    self.tw_currVoices.setRowCount(rowCountF)
-    assert self.tw_currVoices.rowCount() == rowCountF, '{} != {}'.format(self.tw_currVoices.rowCount(), rowCountF)
-    print("refreshCurrVoices entering for loops")
-    for row, voice in zip(range(rowCountF), self.voiceList):
-      for col, attr in enumerate(self.cols):
-        item = self.tw_currVoices.item(row, col)
-        if item is None or item is 0:
-          item = QtGui.QTableWidgetItem(str(voice[attr]))
-          isNewItem = True
-        else:
-          item.setText(str(voice[attr]))
-          isNewItem = False
-        # self.voiceMap[voice] = item
-        item.setFlags(item.flags() ^ QtCore.Qt.ItemIsEditable)
-        item.voice = voice
-        if isNewItem:
-          self.tw_currVoices.setItem(row, col, item)
-    print("refreshCurrVoices returning")
-
   def setVoiceList(self, voiceList):
-    oVoiceList = self.voiceList
     if isinstance(voiceList, str):
       voiceList = self.synthNav.getVoiceList(voiceList)
     self.voiceList = voiceList
-    try:
-      self.refreshCurrVoices()
-    except:
-      self.voiceList = oVoiceList
-      self.refreshCurrVoices()
-      raise
-    else:
-      try:
-        self.voiceList.listModified.disconnect(self.refreshCurrVoices)
-      except:
-        traceback.print_exc()
-    self.voiceList.listModified.connect(self.refreshCurrVoices)
+    self.model.setVoiceList(voiceList)
 
 ##
 #  Widget displaying voices that remain after applying the selected filters.
@@ -117,20 +286,20 @@ class FilteredVoiceListWidget(VoiceListWidget):
   def __init__(self, parent, synthNav):
     self.voiceList = synthNav.getFilteredVoiceList()
     super().__init__(parent, synthNav)
-    self.tw_currVoices.itemDoubleClicked.connect(self.onItemDoubleClicked)
-    self.tw_currVoices.itemSelectionChanged.connect(self.onItemSelectionChanged)
+    self.tv_currVoices.doubleClicked.connect(self.onItemDoubleClicked)
+    self.tv_currVoices.selectionModel().selectionChanged.connect(self.onItemSelectionChanged)
 
-  def onItemDoubleClicked(self, item):
-    self.voiceDoubleClicked.emit(item.voice)
+  def onItemDoubleClicked(self, index):
+    self.voiceDoubleClicked.emit(self.model.getVoice(index.row()))
 
-  def onItemSelectionChanged(self):
-    selectedItems = self.tw_currVoices.selectedItems()
-    if len(selectedItems) > 0:
-      selectedItems[0].voice.pc()
+  def onItemSelectionChanged(self, selected, deselected):
+    selectedVoices = self.getSelectedVoices()
+    if len(selectedVoices) > 0:
+      selectedVoices[0].pc()
 
   def onKeypressEvent(self, event):
     if event.key() in [QtCore.Qt.Key_Enter, QtCore.Qt.Key_Return]:
-      self.synthNav.getVoiceList('queued').adds(item.voice for item in self.tw_currVoices.selectedItems())
+      self.synthNav.getVoiceList('queued').adds(self.getSelectedVoices())
       
 class VoiceListSelectWidget(QtGui.QComboBox):
 
@@ -154,28 +323,28 @@ class VoiceListEditWidget(VoiceListWidget):
     self.pb_clearQueue = QtGui.QPushButton("Clear Queue")
     self.vbox.addWidget(self.pb_clearQueue)
     self.pb_clearQueue.pressed.connect(self.onClearButtonPressed)
-    self.tw_currVoices.itemDoubleClicked.connect(self.onItemDoubleClicked)
+    self.tv_currVoices.doubleClicked.connect(self.onItemDoubleClicked)
 
   def onClearButtonPressed(self):
     self.voiceList.clear()
 
-  def onItemDoubleClicked(self, item):
-    item.voice.pc()
+  def onItemDoubleClicked(self, index):
+    self.model.getVoice(index.row()).pc()
 
   def onKeypressEvent(self, event):
     if event.key() in [QtCore.Qt.Key_Enter, QtCore.Qt.Key_Return]:
-      items = self.tw_currVoices.selectedItems()
+      voices = self.getSelectedVoices()
       try:
-        item = items[0]
+        voice = voices[0]
       except IndexError:
         pass
       else:
-        item.voice.pc()
+        voice.pc()
     elif event.key() in [QtCore.Qt.Key_Delete]:
-      currCell = [self.tw_currVoices.currentRow(), self.tw_currVoices.currentColumn()]
-      items = self.tw_currVoices.selectedItems()
-      self.voiceList.remove(*(item.voice for item in items))
-      if currCell[0] >= self.tw_currVoices.rowCount():
-        currCell[0] = self.tw_currVoices.rowCount()
-      self.tw_currVoices.setCurrentCell(*currCell)
+      currIndex = self.tv_currVoices.currentIndex()
+      currCell = [currIndex.row(), currIndex.column()]
+      self.voiceList.remove(*self.getSelectedVoices())
+      if currCell[0] >= self.model.rowCount():
+        currCell[0] = self.model.rowCount() - 1
+      self.tv_currVoices.setCurrentIndex(self.model.index(*currCell))
 
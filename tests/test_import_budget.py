@@ -0,0 +1,99 @@
+####################################################################################################
+# Copyright 2013 John Crawford
+#
+# This file is part of PatchCorral.
+#
+# PatchCorral is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PatchCorral is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PatchCorral.  If not, see <http://www.gnu.org/licenses/>.
+####################################################################################################
+
+## @file
+#  Guards startup against eager imports: importing the synthesizer registry must not import any
+#  synthesizer driver or bank module (see src.data.synthesizers.getSynthesizer).
+
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+
+
+## Directory holding this checkout, which is the "patchcorral" package.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+## Packages of the synthesizer drivers and their banks.
+DRIVERS = ('rolandfantomxr', 'generalmidi', 'nordstage2')
+
+## Most "patchcorral" modules importing the registry may add to those its dependencies import.
+MODULE_BUDGET = 2
+
+## Most seconds importing the registry may take once its dependencies are imported.
+TIME_BUDGET = 0.25
+
+## Run in a fresh interpreter; prints the modules and time the registry import added.
+SCRIPT = '''
+import json, sys, time
+import patchcorral.src.engine.mididevice
+before = set(sys.modules)
+start = time.perf_counter()
+import patchcorral.src.data.synthesizers
+elapsed = time.perf_counter() - start
+print(json.dumps({
+  "added": sorted(set(sys.modules) - before),
+  "elapsed": elapsed,
+  "modules": sorted(sys.modules),
+}))
+'''
+
+##
+#  Returns a directory to put on "sys.path" so "patchcorral" imports this checkout.
+#  @param tmpdir Directory the checkout may be linked from if it isn't named "patchcorral".
+#  @return String.
+def getSearchPath(tmpdir):
+  if os.path.basename(ROOT) == 'patchcorral':
+    return os.path.dirname(ROOT)
+  try:
+    os.symlink(ROOT, os.path.join(str(tmpdir), 'patchcorral'), target_is_directory=True)
+  except (NotImplementedError, OSError):
+    pytest.skip('Checkout is not named "patchcorral" and cannot be linked as such.')
+  return str(tmpdir)
+
+##
+#  Imports the registry in a fresh interpreter.
+#  @param tmpdir See "getSearchPath".
+#  @return Dictionary printed by "SCRIPT".
+def importRegistry(tmpdir):
+  for module in ('PySide', 'rtmidi', 'yaml'):
+    pytest.importorskip(module)
+  env = dict(os.environ)
+  env['PYTHONPATH'] = os.pathsep.join(
+    [getSearchPath(tmpdir)] + [p for p in env.get('PYTHONPATH', '').split(os.pathsep) if p]
+  )
+  out = subprocess.check_output([sys.executable, '-c', SCRIPT], env=env, cwd=str(tmpdir))
+  return json.loads(out.decode('utf-8').splitlines()[-1])
+
+def test_registry_imports_no_drivers(tmpdir):
+  result = importRegistry(tmpdir)
+  loaded = [
+    m for m in result['modules']
+    if any('.synthesizers.{}'.format(driver) in m for driver in DRIVERS)
+  ]
+  assert loaded == []
+
+def test_registry_import_budget(tmpdir):
+  result = importRegistry(tmpdir)
+  added = [m for m in result['added'] if m.startswith('patchcorral.')]
+  assert len(added) <= MODULE_BUDGET, added
+  assert result['elapsed'] <= TIME_BUDGET